@@ -8,7 +8,19 @@ where I can, based on looking at the source code and my own experiments.
 # Licensed under the GNU Lesser General Public License v2.1 or later.
 #-
 
+import sys
+import os
 import math
+import array
+import operator
+import itertools
+import mmap
+import threading
+import weakref
+import contextlib
+import concurrent.futures
+from collections import \
+    OrderedDict
 from numbers import \
     Real
 import ctypes as ct
@@ -282,13 +294,13 @@ class PIXMAN :
     # Images
 
     MAX_INDEXED = 256
-    index_type = ct.c_uint
+    index_type = ct.c_ubyte # uint8_t, since MAX_INDEXED <= 256
 
     class indexed_t(ct.Structure) :
         pass
     indexed_t._fields_ = \
         [
-            ("color", ct.c_bool),
+            ("color", ct.c_int), # pixman_bool_t
             ("rgba", ct.c_uint * MAX_INDEXED),
             ("ent", index_type * 32768),
         ]
@@ -433,7 +445,61 @@ class PIXMAN :
     KERNEL_LANCZOS3 = 6
     KERNEL_LANCZOS3_STRETCHED = 7
 
-    # TODO: glyphs
+    # Trapezoids and triangles
+
+    class span_fix_t(ct.Structure) :
+        pass
+    span_fix_t._fields_ = \
+        [
+            ("l", fixed_t),
+            ("r", fixed_t),
+            ("y", fixed_t),
+        ]
+    #end span_fix_t
+
+    class trap_t(ct.Structure) :
+        pass
+    trap_t._fields_ = \
+        [
+            ("top", span_fix_t),
+            ("bot", span_fix_t),
+        ]
+    #end trap_t
+
+    class trapezoid_t(ct.Structure) :
+        pass
+    trapezoid_t._fields_ = \
+        [
+            ("top", fixed_t),
+            ("bottom", fixed_t),
+            ("left", line_fixed_t),
+            ("right", line_fixed_t),
+        ]
+    #end trapezoid_t
+
+    class triangle_t(ct.Structure) :
+        pass
+    triangle_t._fields_ = \
+        [
+            ("p1", point_fixed_t),
+            ("p2", point_fixed_t),
+            ("p3", point_fixed_t),
+        ]
+    #end triangle_t
+
+    # Glyphs
+
+    glyph_cache_t_ptr = ct.c_void_p # opaque
+
+    class glyph_t(ct.Structure) :
+        _fields_ = \
+            [
+                ("x", ct.c_int),
+                ("y", ct.c_int),
+                ("glyph", ct.c_void_p),
+            ]
+    #end glyph_t
+    glyph_t_ptr = ct.POINTER(glyph_t)
 
 #end PIXMAN
 
@@ -507,7 +573,67 @@ pixman_to_cairo_format = dict((cairo_to_pixman_format[k], k) for k in cairo_to_p
   # and mapping back the other way
 pixman_to_cairo_format[PIXMAN.g8] = CAIRO.FORMAT_A8
 
-# TODO: fixed-point and floating-point transformations
+pixman.pixman_transform_init_identity.restype = None
+pixman.pixman_transform_init_identity.argtypes = (ct.c_void_p,)
+pixman.pixman_transform_point_3d.restype = ct.c_bool
+pixman.pixman_transform_point_3d.argtypes = (ct.c_void_p, ct.c_void_p)
+pixman.pixman_transform_point.restype = ct.c_bool
+pixman.pixman_transform_point.argtypes = (ct.c_void_p, ct.c_void_p)
+pixman.pixman_transform_multiply.restype = ct.c_bool
+pixman.pixman_transform_multiply.argtypes = (ct.c_void_p, ct.c_void_p, ct.c_void_p)
+pixman.pixman_transform_init_scale.restype = None
+pixman.pixman_transform_init_scale.argtypes = (ct.c_void_p, PIXMAN.fixed_t, PIXMAN.fixed_t)
+pixman.pixman_transform_scale.restype = ct.c_bool
+pixman.pixman_transform_scale.argtypes = (ct.c_void_p, ct.c_void_p, PIXMAN.fixed_t, PIXMAN.fixed_t)
+pixman.pixman_transform_init_rotate.restype = None
+pixman.pixman_transform_init_rotate.argtypes = (ct.c_void_p, PIXMAN.fixed_t, PIXMAN.fixed_t)
+pixman.pixman_transform_rotate.restype = ct.c_bool
+pixman.pixman_transform_rotate.argtypes = (ct.c_void_p, ct.c_void_p, PIXMAN.fixed_t, PIXMAN.fixed_t)
+pixman.pixman_transform_init_translate.restype = None
+pixman.pixman_transform_init_translate.argtypes = (ct.c_void_p, PIXMAN.fixed_t, PIXMAN.fixed_t)
+pixman.pixman_transform_translate.restype = ct.c_bool
+pixman.pixman_transform_translate.argtypes = (ct.c_void_p, ct.c_void_p, PIXMAN.fixed_t, PIXMAN.fixed_t)
+pixman.pixman_transform_bounds.restype = ct.c_bool
+pixman.pixman_transform_bounds.argtypes = (ct.c_void_p, ct.c_void_p)
+pixman.pixman_transform_invert.restype = ct.c_bool
+pixman.pixman_transform_invert.argtypes = (ct.c_void_p, ct.c_void_p)
+pixman.pixman_transform_is_identity.restype = ct.c_bool
+pixman.pixman_transform_is_identity.argtypes = (ct.c_void_p,)
+pixman.pixman_transform_is_scale.restype = ct.c_bool
+pixman.pixman_transform_is_scale.argtypes = (ct.c_void_p,)
+pixman.pixman_transform_is_int_translate.restype = ct.c_bool
+pixman.pixman_transform_is_int_translate.argtypes = (ct.c_void_p,)
+pixman.pixman_transform_is_inverse.restype = ct.c_bool
+pixman.pixman_transform_is_inverse.argtypes = (ct.c_void_p, ct.c_void_p)
+pixman.pixman_transform_from_pixman_f_transform.restype = ct.c_bool
+pixman.pixman_transform_from_pixman_f_transform.argtypes = (ct.c_void_p, ct.c_void_p)
+pixman.pixman_f_transform_from_pixman_transform.restype = None
+pixman.pixman_f_transform_from_pixman_transform.argtypes = (ct.c_void_p, ct.c_void_p)
+pixman.pixman_f_transform_invert.restype = ct.c_bool
+pixman.pixman_f_transform_invert.argtypes = (ct.c_void_p, ct.c_void_p)
+pixman.pixman_f_transform_point.restype = ct.c_bool
+pixman.pixman_f_transform_point.argtypes = (ct.c_void_p, ct.c_void_p)
+pixman.pixman_f_transform_point_3d.restype = None
+pixman.pixman_f_transform_point_3d.argtypes = (ct.c_void_p, ct.c_void_p)
+pixman.pixman_f_transform_multiply.restype = None
+pixman.pixman_f_transform_multiply.argtypes = (ct.c_void_p, ct.c_void_p, ct.c_void_p)
+pixman.pixman_f_transform_init_scale.restype = None
+pixman.pixman_f_transform_init_scale.argtypes = (ct.c_void_p, ct.c_double, ct.c_double)
+pixman.pixman_f_transform_scale.restype = ct.c_bool
+pixman.pixman_f_transform_scale.argtypes = (ct.c_void_p, ct.c_void_p, ct.c_double, ct.c_double)
+pixman.pixman_f_transform_init_rotate.restype = None
+pixman.pixman_f_transform_init_rotate.argtypes = (ct.c_void_p, ct.c_double, ct.c_double)
+pixman.pixman_f_transform_rotate.restype = ct.c_bool
+pixman.pixman_f_transform_rotate.argtypes = (ct.c_void_p, ct.c_void_p, ct.c_double, ct.c_double)
+pixman.pixman_f_transform_init_translate.restype = None
+pixman.pixman_f_transform_init_translate.argtypes = (ct.c_void_p, ct.c_double, ct.c_double)
+pixman.pixman_f_transform_translate.restype = ct.c_bool
+pixman.pixman_f_transform_translate.argtypes = (ct.c_void_p, ct.c_void_p, ct.c_double, ct.c_double)
+pixman.pixman_f_transform_bounds.restype = ct.c_bool
+pixman.pixman_f_transform_bounds.argtypes = (ct.c_void_p, ct.c_void_p)
+pixman.pixman_f_transform_init_identity.restype = None
+pixman.pixman_f_transform_init_identity.argtypes = (ct.c_void_p,)
+
 # Note there is only the minimum of 16-bit region support
 pixman.pixman_region_init.restype = None
 pixman.pixman_region_init.argtypes = (ct.c_void_p,)
@@ -644,7 +770,41 @@ pixman.pixman_image_composite.argtypes = (PIXMAN.op_t, ct.c_void_p, ct.c_void_p,
 pixman.pixman_image_composite32.restype = None
 pixman.pixman_image_composite32.argtypes = (PIXMAN.op_t, ct.c_void_p, ct.c_void_p, ct.c_void_p, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int)
 
-# TODO: glyphs
+pixman.pixman_rasterize_trapezoid.restype = None
+pixman.pixman_rasterize_trapezoid.argtypes = (ct.c_void_p, ct.c_void_p, ct.c_int, ct.c_int)
+pixman.pixman_add_traps.restype = None
+pixman.pixman_add_traps.argtypes = (ct.c_void_p, ct.c_short, ct.c_short, ct.c_int, ct.c_void_p)
+pixman.pixman_add_trapezoids.restype = None
+pixman.pixman_add_trapezoids.argtypes = (ct.c_void_p, ct.c_short, ct.c_int, ct.c_int, ct.c_void_p)
+pixman.pixman_add_triangles.restype = None
+pixman.pixman_add_triangles.argtypes = (ct.c_void_p, ct.c_int, ct.c_int, ct.c_int, ct.c_void_p)
+pixman.pixman_composite_trapezoids.restype = None
+pixman.pixman_composite_trapezoids.argtypes = (PIXMAN.op_t, ct.c_void_p, ct.c_void_p, PIXMAN.format_code_t, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_void_p)
+pixman.pixman_composite_triangles.restype = None
+pixman.pixman_composite_triangles.argtypes = (PIXMAN.op_t, ct.c_void_p, ct.c_void_p, PIXMAN.format_code_t, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_void_p)
+
+pixman.pixman_glyph_cache_create.restype = PIXMAN.glyph_cache_t_ptr
+pixman.pixman_glyph_cache_create.argtypes = ()
+pixman.pixman_glyph_cache_destroy.restype = None
+pixman.pixman_glyph_cache_destroy.argtypes = (PIXMAN.glyph_cache_t_ptr,)
+pixman.pixman_glyph_cache_freeze.restype = None
+pixman.pixman_glyph_cache_freeze.argtypes = (PIXMAN.glyph_cache_t_ptr,)
+pixman.pixman_glyph_cache_thaw.restype = None
+pixman.pixman_glyph_cache_thaw.argtypes = (PIXMAN.glyph_cache_t_ptr,)
+pixman.pixman_glyph_cache_lookup.restype = ct.c_void_p
+pixman.pixman_glyph_cache_lookup.argtypes = (PIXMAN.glyph_cache_t_ptr, ct.c_void_p, ct.c_void_p)
+pixman.pixman_glyph_cache_insert.restype = ct.c_void_p
+pixman.pixman_glyph_cache_insert.argtypes = (PIXMAN.glyph_cache_t_ptr, ct.c_void_p, ct.c_void_p, ct.c_int, ct.c_int, ct.c_void_p)
+pixman.pixman_glyph_cache_remove.restype = None
+pixman.pixman_glyph_cache_remove.argtypes = (PIXMAN.glyph_cache_t_ptr, ct.c_void_p, ct.c_void_p)
+pixman.pixman_glyph_get_extents.restype = None
+pixman.pixman_glyph_get_extents.argtypes = (PIXMAN.glyph_cache_t_ptr, ct.c_int, ct.c_void_p, ct.c_void_p)
+pixman.pixman_glyph_get_mask_format.restype = PIXMAN.format_code_t
+pixman.pixman_glyph_get_mask_format.argtypes = (PIXMAN.glyph_cache_t_ptr, ct.c_int, ct.c_void_p)
+pixman.pixman_composite_glyphs.restype = None
+pixman.pixman_composite_glyphs.argtypes = (PIXMAN.op_t, ct.c_void_p, ct.c_void_p, PIXMAN.format_code_t, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, ct.c_int, PIXMAN.glyph_cache_t_ptr, ct.c_int, ct.c_void_p)
+pixman.pixman_composite_glyphs_no_mask.restype = None
+pixman.pixman_composite_glyphs_no_mask.argtypes = (PIXMAN.op_t, ct.c_void_p, ct.c_void_p, ct.c_int, ct.c_int, ct.c_int, ct.c_int, PIXMAN.glyph_cache_t_ptr, ct.c_int, ct.c_void_p)
 
 libc.malloc.restype = ct.c_void_p
 libc.malloc.argtypes = (ct.c_size_t,)
@@ -667,6 +827,144 @@ def version_string() :
         pixman.pixman_version_string()
 #end version_string
 
+class _CacheStats :
+    # common base for LRUCache and ImagePool, keeping counts of hits, misses and
+    # evictions. Subclasses must implement __len__ and size.
+
+    __slots__ = ("hits", "misses", "evictions") # to forestall typos
+
+    count_name = None # overridden by subclass
+    limit_name = None # overridden by subclass
+
+    def _reset_stats(self) :
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    #end _reset_stats
+
+    @property
+    def hit_rate(self) :
+        "the fraction of lookups that found something to reuse, or None if there" \
+        " have not been any lookups yet."
+        total = self.hits + self.misses
+        return \
+            (None, self.hits / (total or 1))[total != 0]
+    #end hit_rate
+
+    def __repr__(self) :
+        return \
+            (
+                "%s(%s = %d, size = %d/%d, hits = %d, misses = %d, evictions = %d)"
+            %
+                (
+                    type(self).__name__, self.count_name, len(self),
+                    self.size, getattr(self, self.limit_name),
+                    self.hits, self.misses, self.evictions,
+                )
+            )
+    #end __repr__
+
+#end _CacheStats
+
+class LRUCache(_CacheStats) :
+    "a thread-safe cache of objects, indexed by hashable keys, which discards the" \
+    " least-recently-used entries once their total size exceeds max_size. size_of is" \
+    " a function that returns the size of an object to be cached, in whatever units" \
+    " max_size is expressed in (e.g. bytes); if None, each object counts as 1, so" \
+    " max_size is a limit on the number of entries. The cache keeps count of hits," \
+    " misses and evictions, for tuning max_size. Cached objects are shared between all" \
+    " callers, so should not be modified."
+
+    __slots__ = \
+        (
+            "max_size",
+            "_size_of",
+            "_entries",
+            "_size",
+            "_lock",
+        ) # to forestall typos
+
+    count_name = "entries"
+    limit_name = "max_size"
+
+    def __init__(self, max_size, size_of = None) :
+        self.max_size = max_size
+        self._size_of = size_of
+        self._entries = OrderedDict() # key => (obj, size), in least-to-most-recently-used order
+        self._size = 0
+        self._lock = threading.Lock()
+        self._reset_stats()
+    #end __init__
+
+    def _evict(self) :
+        # discards least-recently-used entries until within max_size. Caller must
+        # hold the lock.
+        while self._size > self.max_size and len(self._entries) != 0 :
+            self._size -= self._entries.popitem(last = False)[1][1]
+            self.evictions += 1
+        #end while
+    #end _evict
+
+    def get(self, key, create) :
+        "returns the object cached under key if present, otherwise calls create() to" \
+        " make the object, and adds it to the cache."
+        with self._lock :
+            entry = self._entries.get(key)
+            if entry != None :
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else :
+                self.misses += 1
+            #end if
+        #end with
+        if entry == None :
+            obj = create() # outside lock, so other threads are not held up
+            if self._size_of != None :
+                size = self._size_of(obj)
+            else :
+                size = 1
+            #end if
+            with self._lock :
+                entry = self._entries.get(key)
+                if entry == None :
+                    # not added by another thread in the meantime
+                    entry = (obj, size)
+                    self._entries[key] = entry
+                    self._size += size
+                    self._evict()
+                #end if
+            #end with
+        #end if
+        return \
+            entry[0]
+    #end get
+
+    def clear(self) :
+        "discards all entries from the cache, and resets the statistics."
+        with self._lock :
+            self._entries.clear()
+            self._size = 0
+            self._reset_stats()
+        #end with
+        return \
+            self
+    #end clear
+
+    def __len__(self) :
+        "the number of entries currently in the cache."
+        return \
+            len(self._entries)
+    #end __len__
+
+    @property
+    def size(self) :
+        "the total size of the entries currently in the cache."
+        return \
+            self._size
+    #end size
+
+#end LRUCache
+
 class Point(qah.Vector) :
     "augment qahirah.Vector with additional Pixman-specific functionality."
 
@@ -735,22 +1033,34 @@ class Transform(qah.Matrix) :
 
     @classmethod
     def from_pixman_fixed(celf, m) :
+        "converts a PIXMAN.transform to a Transform. The bottom row must be" \
+        " (0, 0, w) for some nonzero w, which is divided out; projective" \
+        " transformations cannot be represented, and raise ValueError."
+        matrix = m.matrix
+        if matrix[2][0] != 0 or matrix[2][1] != 0 or matrix[2][2] == 0 :
+            raise ValueError("not an affine transform")
+        #end if
+        w = matrix[2][2]
         return \
             celf \
               (
-                xx = PIXMAN.fixed_to_double(m.matrix[0][0]),
-                xy = PIXMAN.fixed_to_double(m.matrix[0][1]),
-                x0 = PIXMAN.fixed_to_double(m.matrix[0][2]),
-                yx = PIXMAN.fixed_to_double(m.matrix[1][0]),
-                yy = PIXMAN.fixed_to_double(m.matrix[1][1]),
-                y0 = PIXMAN.fixed_to_double(m.matrix[1][2]),
-                # FIXME: non-affine components ignored for now
+                xx = matrix[0][0] / w,
+                xy = matrix[0][1] / w,
+                x0 = matrix[0][2] / w,
+                yx = matrix[1][0] / w,
+                yy = matrix[1][1] / w,
+                y0 = matrix[1][2] / w,
               )
     #end from_pixman_fixed
 
-    def to_pixman_fixed(self) :
-        return \
-            PIXMAN.transform \
+    def to_pixman_fixed(self, cached = False) :
+        "converts this Transform to a PIXMAN.transform. If cached, the result" \
+        " is shared through Transform.fixed_cache with all other conversions of" \
+        " the same matrix, so the caller must not modify it."
+        if cached :
+            result = Transform.fixed_cache.get(tuple(self), self.to_pixman_fixed)
+        else :
+            result = PIXMAN.transform \
               (
                 matrix =
                     ((PIXMAN.fixed_t * 3) * 3)
@@ -775,10 +1085,166 @@ class Transform(qah.Matrix) :
                           ),
                     )
               )
+        #end if
+        return \
+            result
     #end to_pixman_fixed
 
+    @classmethod
+    def from_pixman_float(celf, m) :
+        "converts a PIXMAN.f_transform to a Transform. As with from_pixman_fixed," \
+        " the bottom row must be (0, 0, w) for some nonzero w."
+        matrix = m.matrix
+        if matrix[2][0] != 0 or matrix[2][1] != 0 or matrix[2][2] == 0 :
+            raise ValueError("not an affine transform")
+        #end if
+        w = matrix[2][2]
+        return \
+            celf \
+              (
+                xx = matrix[0][0] / w,
+                xy = matrix[0][1] / w,
+                x0 = matrix[0][2] / w,
+                yx = matrix[1][0] / w,
+                yy = matrix[1][1] / w,
+                y0 = matrix[1][2] / w,
+              )
+    #end from_pixman_float
+
+    def to_pixman_float(self) :
+        "converts this Transform to a PIXMAN.f_transform."
+        return \
+            PIXMAN.f_transform \
+              (
+                matrix =
+                    ((ct.c_double * 3) * 3)
+                    (
+                        (ct.c_double * 3)(self.xx, self.xy, self.x0),
+                        (ct.c_double * 3)(self.yx, self.yy, self.y0),
+                        (ct.c_double * 3)(0, 0, 1),
+                    )
+              )
+    #end to_pixman_float
+
+    def invert(self, fixed = False) :
+        "returns the inverse of this Transform, as computed by Pixman. If fixed, the" \
+        " computation is done on the fixed-point form, giving exactly the inverse Pixman" \
+        " itself would use; otherwise it is done in floating-point. Raises ValueError" \
+        " if the Transform is not invertible."
+        if fixed :
+            c_result = PIXMAN.transform()
+            success = pixman.pixman_transform_invert \
+              (
+                ct.byref(c_result),
+                ct.byref(self.to_pixman_fixed(cached = True))
+              )
+            conv = type(self).from_pixman_fixed
+        else :
+            c_result = PIXMAN.f_transform()
+            success = pixman.pixman_f_transform_invert(ct.byref(c_result), ct.byref(self.to_pixman_float()))
+            conv = type(self).from_pixman_float
+        #end if
+        if not success :
+            raise ValueError("Transform is not invertible")
+        #end if
+        return \
+            conv(c_result)
+    #end invert
+
+    def multiply(m1, m2, fixed = False) :
+        "returns the product of two Transforms, as computed by Pixman, which maps a" \
+        " point by m2 and then by m1, like m1 * m2. If fixed, the computation is done" \
+        " on the fixed-point forms, with Pixman’s rounding; otherwise in floating-point."
+        m2 = Transform.from_matrix(m2)
+        if fixed :
+            c_result = PIXMAN.transform()
+            if not pixman.pixman_transform_multiply \
+              (
+                ct.byref(c_result),
+                ct.byref(m1.to_pixman_fixed(cached = True)),
+                ct.byref(m2.to_pixman_fixed(cached = True))
+              ) :
+                raise ValueError("Transform multiplication overflow")
+            #end if
+            result = type(m1).from_pixman_fixed(c_result)
+        else :
+            c_result = PIXMAN.f_transform()
+            pixman.pixman_f_transform_multiply \
+              (
+                ct.byref(c_result),
+                ct.byref(m1.to_pixman_float()),
+                ct.byref(m2.to_pixman_float())
+              )
+            result = type(m1).from_pixman_float(c_result)
+        #end if
+        return \
+            result
+    #end multiply
+
+    def bounds(self, rect) :
+        "returns the integer Rect bounding the image of the given Rect under this" \
+        " Transform, as Pixman computes it from the fixed-point form. The Rect and" \
+        " the result must both have 16-bit coordinates."
+        rect = Rect.from_rect(rect)
+        if not rect.isshortint() :
+            raise ValueError("rect coordinates must be signed 16-bit integers")
+        #end if
+        c_box = PIXMAN.box16_t(rect.left, rect.top, rect.right, rect.bottom)
+        if not pixman.pixman_transform_bounds(ct.byref(self.to_pixman_fixed(cached = True)), ct.byref(c_box)) :
+            raise ValueError("transformed bounds overflow 16 bits")
+        #end if
+        return \
+            Rect.from_pixman_box(c_box)
+    #end bounds
+
+    @property
+    def is_identity(self) :
+        "whether Pixman treats the fixed-point form of this Transform as the identity."
+        return \
+            pixman.pixman_transform_is_identity(ct.byref(self.to_pixman_fixed(cached = True)))
+    #end is_identity
+
+    def transform_points(self, points) :
+        "maps a whole array of points through this Transform in one call. points may" \
+        " be a NumPy array of shape (n, 2), in which case the result is a new NumPy" \
+        " array of float64 of the same shape; otherwise it must be a flat sequence" \
+        " of alternating x and y coordinates, such as an array.array, and the result" \
+        " is an array.array of doubles in the same layout."
+        if _is_ndarray(points) :
+            import numpy
+            points = numpy.asarray(points, dtype = numpy.float64)
+            if points.ndim != 2 or points.shape[1] != 2 :
+                raise ValueError("points array must have shape (n, 2)")
+            #end if
+            result = \
+                (
+                    points @ numpy.array(((self.xx, self.yx), (self.xy, self.yy)))
+                +
+                    numpy.array((self.x0, self.y0))
+                )
+        else :
+            if not isinstance(points, array.array) :
+                points = array.array("d", points)
+            #end if
+            if len(points) % 2 != 0 :
+                raise ValueError("points must have an even number of coordinates")
+            #end if
+            xx, xy, x0, yx, yy, y0 = self.xx, self.xy, self.x0, self.yx, self.yy, self.y0
+            coords = iter(points)
+            result = array.array("d")
+            for x, y in zip(coords, coords) :
+                result.append(xx * x + xy * y + x0)
+                result.append(yx * x + yy * y + y0)
+            #end for
+        #end if
+        return \
+            result
+    #end transform_points
+
 #end Transform
 Transform.identity = Transform.from_matrix(qah.Matrix.identity)
+Transform.fixed_cache = LRUCache(max_size = 256)
+  # conversions shared by to_pixman_fixed(cached = True)
 
 class Rect(qah.Rect) :
     "augment qahirah.Rect with additional Pixman-specific functionality."
@@ -888,6 +1354,32 @@ class Region :
             (result, validated)
     #end create_rects
 
+    @staticmethod
+    def create_from_boxes(boxes) :
+        "creates a Region from a flat buffer of 32-bit integers, taken in groups of four" \
+        " as x1, y1, x2, y2 box coordinates. boxes may be an array.array or NumPy array" \
+        " of int32, or anything else supporting the buffer protocol with 4-byte integer" \
+        " elements; a writable contiguous buffer is passed to Pixman without copying." \
+        " Integer arrays and buffers of other sizes, and any other sequence of integers," \
+        " are converted first, raising an exception if any value does not fit in 32 bits;" \
+        " non-integer data raises TypeError. Like create_rects, returns a tuple of" \
+        " (region, validated)."
+        c_boxes = _int32_view(boxes).cast("B")
+        nr_values = len(c_boxes) // 4
+        if nr_values % 4 != 0 :
+            raise ValueError("number of box coordinates must be a multiple of 4")
+        #end if
+        if c_boxes.readonly :
+            c_boxes = (ct.c_int32 * nr_values).from_buffer_copy(c_boxes)
+        else :
+            c_boxes = (ct.c_int32 * nr_values).from_buffer(c_boxes)
+        #end if
+        result = Region()
+        validated = pixman.pixman_region32_init_rects(ct.byref(result._region), c_boxes, nr_values // 4)
+        return \
+            (result, validated)
+    #end create_from_boxes
+
     @staticmethod
     def create_with_extents(extents) :
         result = Region()
@@ -917,7 +1409,7 @@ class Region :
         #end if
     #end __del__
 
-    def translate(offset) :
+    def translate(self, offset) :
         offset = Point.from_tuple(offset).assert_isint()
         pixman.pixman_region32_translate(ct.byref(self._region), offset.x, offset.y)
         return \
@@ -936,26 +1428,30 @@ class Region :
     #end copy
 
     def intersect(reg1, reg2, new_reg) :
-        if not isinstance(reg1, Region) or not isinstance(new_reg, Region) :
+        "puts the intersection of reg1 and reg2 into new_reg, which may be the same" \
+        " as either of them."
+        if not isinstance(reg2, Region) or not isinstance(new_reg, Region) :
             raise TypeError("args must be Regions")
         #end if
         if not pixman.pixman_region32_intersect(ct.byref(new_reg._region), ct.byref(reg1._region), ct.byref(reg2._region)) :
             raise MemoryError("Pixman couldn’t intersect regions")
         #end if
         return \
-            self
+            reg1
     #end intersect
 
     def union(reg1, reg2, new_reg) :
-        if not isinstance(reg1, Region) or not isinstance(new_reg, Region) :
+        "puts the union of reg1 and reg2 into new_reg, which may be the same as either" \
+        " of them."
+        if not isinstance(reg2, Region) or not isinstance(new_reg, Region) :
             raise TypeError("args must be Regions")
         #end if
         if not pixman.pixman_region32_union(ct.byref(new_reg._region), ct.byref(reg1._region), ct.byref(reg2._region)) :
             raise MemoryError("Pixman couldn’t union regions")
         #end if
         return \
-            self
-    #end intersect
+            reg1
+    #end union
 
     def intersect_rect(self, rect, dest) :
         if not isinstance(dest, Region) :
@@ -982,16 +1478,162 @@ class Region :
     #end union_rect
 
     def subtract(reg1, reg2, new_reg) :
-        if not isinstance(reg1, Region) or not isinstance(new_reg, Region) :
+        "puts the parts of reg1 not in reg2 into new_reg, which may be the same as" \
+        " either of them."
+        if not isinstance(reg2, Region) or not isinstance(new_reg, Region) :
             raise TypeError("args must be Regions")
         #end if
         if not pixman.pixman_region32_subtract(ct.byref(new_reg._region), ct.byref(reg1._region), ct.byref(reg2._region)) :
             raise MemoryError("Pixman couldn’t subtract regions")
         #end if
         return \
-            self
+            reg1
     #end subtract
 
+    @staticmethod
+    def _combine_all(regions, combine) :
+        # merges a sequence of Regions with the given binary operation by
+        # balanced pairwise rounds, so the intermediate Regions stay small
+        # and there are only about log2(len(regions)) rounds. The operands
+        # are left unchanged; temporaries from one round are reused as
+        # destinations in the next.
+        regions = list(regions)
+        for region in regions :
+            if not isinstance(region, Region) :
+                raise TypeError("args must be Regions")
+            #end if
+        #end for
+        temps = set()
+        while len(regions) > 1 :
+            merged = []
+            for i in range(0, len(regions) - 1, 2) :
+                reg1, reg2 = regions[i], regions[i + 1]
+                if id(reg1) in temps :
+                    dest = reg1
+                elif id(reg2) in temps :
+                    dest = reg2
+                else :
+                    dest = Region.create()
+                    temps.add(id(dest))
+                #end if
+                combine(reg1, reg2, dest)
+                merged.append(dest)
+            #end for
+            if len(regions) % 2 != 0 :
+                merged.append(regions[-1])
+            #end if
+            regions = merged
+        #end while
+        result = regions[0]
+        if id(result) not in temps :
+            # don’t return one of the caller’s Regions
+            copy = Region.create()
+            result.copy(copy)
+            result = copy
+        #end if
+        return \
+            result
+    #end _combine_all
+
+    @staticmethod
+    def union_all(regions) :
+        "returns a new Region which is the union of all the Regions in the given" \
+        " sequence, merged pairwise in about log2(len(regions)) rounds. The result" \
+        " is empty if the sequence is empty."
+        regions = list(regions)
+        if len(regions) == 0 :
+            result = Region.create()
+        else :
+            result = Region._combine_all(regions, Region.union)
+        #end if
+        return \
+            result
+    #end union_all
+
+    @staticmethod
+    def intersect_all(regions) :
+        "returns a new Region which is the intersection of all the Regions in the" \
+        " given nonempty sequence, merged pairwise in about log2(len(regions)) rounds."
+        regions = list(regions)
+        if len(regions) == 0 :
+            raise ValueError("need at least one Region to intersect")
+        #end if
+        return \
+            Region._combine_all(regions, Region.intersect)
+    #end intersect_all
+
+    def __or__(reg1, reg2) :
+        "returns a new Region which is the union of reg1 and reg2."
+        if isinstance(reg2, Region) :
+            result = Region.create()
+            reg1.union(reg2, result)
+        else :
+            result = NotImplemented
+        #end if
+        return \
+            result
+    #end __or__
+
+    def __and__(reg1, reg2) :
+        "returns a new Region which is the intersection of reg1 and reg2."
+        if isinstance(reg2, Region) :
+            result = Region.create()
+            reg1.intersect(reg2, result)
+        else :
+            result = NotImplemented
+        #end if
+        return \
+            result
+    #end __and__
+
+    def __sub__(reg1, reg2) :
+        "returns a new Region which is the parts of reg1 not in reg2."
+        if isinstance(reg2, Region) :
+            result = Region.create()
+            reg1.subtract(reg2, result)
+        else :
+            result = NotImplemented
+        #end if
+        return \
+            result
+    #end __sub__
+
+    def __ior__(self, other) :
+        "adds the other Region to this one, in place."
+        if isinstance(other, Region) :
+            self.union(other, self)
+            result = self
+        else :
+            result = NotImplemented
+        #end if
+        return \
+            result
+    #end __ior__
+
+    def __iand__(self, other) :
+        "restricts this Region to its intersection with the other one, in place."
+        if isinstance(other, Region) :
+            self.intersect(other, self)
+            result = self
+        else :
+            result = NotImplemented
+        #end if
+        return \
+            result
+    #end __iand__
+
+    def __isub__(self, other) :
+        "removes the other Region from this one, in place."
+        if isinstance(other, Region) :
+            self.subtract(other, self)
+            result = self
+        else :
+            result = NotImplemented
+        #end if
+        return \
+            result
+    #end __isub__
+
     def inverse(self, inv_rect, new_reg) :
         if not isinstance(new_reg, Region) :
             raise TypeError("new_reg must be Region")
@@ -1059,13 +1701,44 @@ class Region :
         #end for
     #end rectangles
 
+    def boxes(self) :
+        "returns a read-only memoryview of shape (n_rects, 4) that accesses the x1, y1," \
+        " x2, y2 coordinates of the rectangles making up the Region directly, without" \
+        " copying. It keeps a reference to the Region, but is only valid until the" \
+        " Region is next changed. If the Region is empty, the result is an empty" \
+        " one-dimensional memoryview, since a memoryview cannot have a zero dimension."
+        nr_rects = ct.c_int()
+        rects = pixman.pixman_region32_rectangles(ct.byref(self._region), ct.byref(nr_rects))
+        nr_rects = nr_rects.value
+        if nr_rects != 0 :
+            c_boxes = (ct.c_int32 * (nr_rects * 4)).from_address(rects)
+            c_boxes._pixman_region = self # ensure boxes don’t go away prematurely
+            result = memoryview(c_boxes).cast("B").cast("i", (nr_rects, 4))
+        else :
+            result = memoryview(array.array("i"))
+        #end if
+        return \
+            result.toreadonly()
+    #end boxes
+
+    def boxes_as_ndarray(self) :
+        "returns a read-only NumPy array of int32 with shape (n_rects, 4), accessing the" \
+        " rectangles as for boxes(), and with the same validity. Requires NumPy to be" \
+        " installed."
+        import numpy
+        return \
+            numpy.asarray(self.boxes(), dtype = numpy.int32).reshape((-1, 4))
+    #end boxes_as_ndarray
+
     def __eq__(rgn1, rgn2) :
         "equality of two Regions."
-        if not isinstance(rgn2, Region) :
-            raise TypeError("args must be Regions")
+        if isinstance(rgn2, Region) :
+            result = pixman.pixman_region32_equal(ct.byref(rgn1._region), ct.byref(rgn2._region))
+        else :
+            result = NotImplemented # so comparisons against None work
         #end if
         return \
-            pixman.pixman_region32_equal(ct.byref(rgn1._region), ct.byref(rgn2._region))
+            result
     #end __eq__
 
     def selfcheck(self) :
@@ -1168,8 +1841,14 @@ class GradientStop :
         " gradient_stop_t values along with the length of the array."
         nr_stops = len(stops)
         c_stops = (PIXMAN.gradient_stop_t * nr_stops)()
+        positions = doubles_to_fixed(stop.x for stop in stops)
+        c_colours = (PIXMAN.color_t * nr_stops).from_buffer \
+          (
+            colours_to_pixman(itertools.chain.from_iterable(tuple(stop.colour) for stop in stops))
+          )
         for i in range(nr_stops) :
-            c_stops[i] = stops[i].to_pixman()
+            c_stops[i].x = positions[i]
+            c_stops[i].color = c_colours[i]
         #end for
         return \
             c_stops, nr_stops
@@ -1177,6 +1856,175 @@ class GradientStop :
 
 #end GradientStop
 
+class Palette :
+    "a colour table for use with the indexed pixel formats (c8, c4, g8, g4 etc)," \
+    " together with the inverse lookup table that Pixman uses for converting colours" \
+    " back to indexes. Do not instantiate directly; use the create method, which" \
+    " returns an existing Palette with the same contents if there is one, so the" \
+    " (about 33KiB) lookup table is only built once however many Images share it."
+
+    __slots__ = ("_indexed", "colours", "grey", "__weakref__") # to forestall typos
+
+    def __init__(self, _indexed, colours, grey) :
+        self._indexed = _indexed
+        self.colours = colours
+        self.grey = grey
+    #end __init__
+
+    @staticmethod
+    def create(colours, grey = False) :
+        "returns a Palette for the given sequence of up to PIXMAN.MAX_INDEXED colours," \
+        " each of which may be a Colour or an integer premultiplied a8r8g8b8 pixel value." \
+        " grey indicates the Palette is for one of the grey formats, where colours are" \
+        " converted to indexes by luminance rather than by nearest RGB value."
+        rgba = []
+        for c in colours :
+            if isinstance(c, int) :
+                if not 0 <= c < 1 << 32 :
+                    raise ValueError("pixel value out of range: %#x" % c)
+                #end if
+            else :
+                c = Colour.from_colour(c)
+                c = \
+                    (
+                        round(c.a * 255) << 24
+                    |
+                        round(c.r * c.a * 255) << 16
+                    |
+                        round(c.g * c.a * 255) << 8
+                    |
+                        round(c.b * c.a * 255)
+                    )
+            #end if
+            rgba.append(c)
+        #end for
+        rgba = tuple(rgba)
+        if not 0 < len(rgba) <= PIXMAN.MAX_INDEXED :
+            raise ValueError("need 1 .. %d palette colours" % PIXMAN.MAX_INDEXED)
+        #end if
+        key = (bool(grey), rgba)
+        with Palette._interned_lock :
+            result = Palette._interned.get(key)
+        #end with
+        if result == None :
+            # build outside lock, might take a while
+            indexed = PIXMAN.indexed_t()
+            indexed.color = not grey
+            for i, c in enumerate(rgba) :
+                indexed.rgba[i] = c
+            #end for
+            ct.memmove(indexed.ent, Palette._inverse_map(rgba, grey), len(indexed.ent))
+            with Palette._interned_lock :
+                result = Palette._interned.get(key)
+                if result == None :
+                    result = Palette(indexed, rgba, bool(grey))
+                    Palette._interned[key] = result
+                #end if
+            #end with
+        #end if
+        return \
+            result
+    #end create
+
+    @staticmethod
+    def _inverse_map(rgba, grey) :
+        # returns a bytes object mapping each Pixman 15-bit colour key to the
+        # index of the nearest palette entry. For colour palettes, the key is
+        # an r5g5b5 value, and nearness is Euclidean distance in RGB; for grey
+        # palettes, the key is Pixman’s 15-bit luminance value. Ties go to the
+        # lowest index.
+        nr_keys = 32768
+        if grey :
+            entries = list \
+              (
+                (c >> 16 & 0xff) * 153 + (c >> 8 & 0xff) * 301 + (c & 0xff) * 58 >> 2
+                for c in rgba
+              )
+        else :
+            entries = list((c >> 16 & 0xff, c >> 8 & 0xff, c & 0xff) for c in rgba)
+        #end if
+        try :
+            import numpy
+        except ImportError :
+            numpy = None
+        #end try
+        if numpy != None :
+            keys = numpy.arange(nr_keys, dtype = numpy.int32)
+            if grey :
+                dist = lambda k : abs(k[:, numpy.newaxis] - numpy.array(entries, dtype = numpy.int32))
+            else :
+                expand = lambda c5 : c5 << 3 | c5 >> 2
+                palette = numpy.array(entries, dtype = numpy.int32)
+                dist = lambda k : \
+                    (
+                        (expand(k >> 10 & 31)[:, numpy.newaxis] - palette[:, 0]) ** 2
+                    +
+                        (expand(k >> 5 & 31)[:, numpy.newaxis] - palette[:, 1]) ** 2
+                    +
+                        (expand(k & 31)[:, numpy.newaxis] - palette[:, 2]) ** 2
+                    )
+            #end if
+            result = numpy.empty(nr_keys, dtype = numpy.uint8)
+            chunk = 4096 # limit size of temporary distance arrays
+            for i in range(0, nr_keys, chunk) :
+                result[i : i + chunk] = numpy.argmin(dist(keys[i : i + chunk]), axis = 1)
+            #end for
+            result = result.tobytes()
+        else :
+            best_dist = [math.inf] * nr_keys
+            result = bytearray(nr_keys)
+            if grey :
+                for index, y in enumerate(entries) :
+                    for k in range(nr_keys) :
+                        d = abs(k - y)
+                        if d < best_dist[k] :
+                            best_dist[k] = d
+                            result[k] = index
+                        #end if
+                    #end for
+                #end for
+            else :
+                expanded = list(c5 << 3 | c5 >> 2 for c5 in range(32))
+                for index, (r, g, b) in enumerate(entries) :
+                    dr = list((c - r) ** 2 for c in expanded)
+                    dg = list((c - g) ** 2 for c in expanded)
+                    db = list((c - b) ** 2 for c in expanded)
+                    k = 0
+                    for r5 in range(32) :
+                        for g5 in range(32) :
+                            drg = dr[r5] + dg[g5]
+                            for b5 in range(32) :
+                                d = drg + db[b5]
+                                if d < best_dist[k] :
+                                    best_dist[k] = d
+                                    result[k] = index
+                                #end if
+                                k += 1
+                            #end for
+                        #end for
+                    #end for
+                #end for
+            #end if
+            result = bytes(result)
+        #end if
+        return \
+            result
+    #end _inverse_map
+
+    def __len__(self) :
+        return \
+            len(self.colours)
+    #end __len__
+
+    def __repr__(self) :
+        return \
+            "Palette(%s, grey = %s)" % (", ".join("%#010x" % c for c in self.colours), self.grey)
+    #end __repr__
+
+#end Palette
+Palette._interned = weakref.WeakValueDictionary() # (grey, colours) => Palette
+Palette._interned_lock = threading.Lock()
+
 def format_supported_destination(format) :
     "is the format with the specified code supported for destination images."
     return \
@@ -1189,104 +2037,462 @@ def format_supported_source(format) :
         pixman.pixman_format_supported_source(format)
 #end format_supported_source
 
-class Filter :
-    "a Pixman filter type together with associated coefficients, if any. Do not" \
-    " instantiate directly; use one of the create methods, or one of the predefined" \
-    " instances FAST, GOOD, BEST, NEAREST or BILINEAR."
-
-    __slots__ = ("_type", "_values", "_nr_values") # to forestall typos
-
-    def __init__(self, _type, _values, _nr_values) :
-        self._type = _type
-        self._values = _values
-        self._nr_values = _nr_values
-    #end __init__
+def format_stride(format, width) :
+    "returns the minimum stride in bytes for rows of the specified number of pixels" \
+    " in the format with the specified code, rounded up to a multiple of 4 bytes as" \
+    " Pixman requires."
+    return \
+        (PIXMAN.FORMAT_BPP(format) * width + 31) // 32 * 4
+#end format_stride
 
-    def __del__(self) :
+def _is_ndarray(obj) :
+    # is obj a NumPy array. Doesn’t import NumPy if the caller hasn’t already done so.
+    numpy = sys.modules.get("numpy")
+    return \
+        numpy != None and isinstance(obj, numpy.ndarray)
+#end _is_ndarray
+
+def _int32_view(values) :
+    # returns a contiguous one-dimensional memoryview of format "i" over the
+    # values, which may be a NumPy array of integers, any buffer of native
+    # integers, or any other sequence of integers. Buffers of bytes are taken
+    # as raw 32-bit values; buffers of 32-bit integers are used without copying;
+    # other integers are converted, raising an exception if any is out of range.
+    # Non-integer values raise TypeError.
+    if _is_ndarray(values) :
+        import numpy
+        if values.dtype.kind not in "iu" :
+            raise TypeError("need an array of integers, not dtype %s" % values.dtype)
+        #end if
+        if (
+                values.dtype != numpy.int32
+            and
+                values.size != 0
+            and
+                (values.min() < - (1 << 31) or values.max() >= 1 << 31)
+        ) :
+            raise ValueError("values out of range for 32-bit integers")
+        #end if
+        result = memoryview(numpy.ascontiguousarray(values, dtype = numpy.int32).ravel())
+    else :
+        try :
+            view = memoryview(values)
+        except TypeError :
+            view = None
+        #end try
+        if view != None :
+            elt_format = view.format
+            if elt_format[:1] in ("@", "=", {"little" : "<", "big" : ">"}[sys.byteorder]) :
+                elt_format = elt_format[1:]
+            #end if
+            if elt_format not in ("b", "B", "c", "h", "H", "i", "I", "l", "L", "q", "Q", "n", "N") :
+                raise TypeError("need a buffer of native integers, not format %r" % view.format)
+            #end if
+            if not view.c_contiguous :
+                view = memoryview(view.tobytes())
+            #end if
+            view = view.cast("B")
+            if view.itemsize == 1 and elt_format in ("b", "B", "c") or elt_format in ("i", "l") and view.itemsize == 4 :
+                if len(view) % 4 != 0 :
+                    raise ValueError("buffer length must be a multiple of 4 bytes")
+                #end if
+                result = view.cast("i")
+            else :
+                result = memoryview(array.array("i", view.cast(elt_format)))
+            #end if
+        else :
+            result = memoryview(array.array("i", values))
+        #end if
+    #end if
+    if result.format != "i" :
+        result = result.cast("B").cast("i")
+    #end if
+    return \
+        result
+#end _int32_view
+
+def doubles_to_fixed(values) :
+    "converts a sequence of reals to an array.array of PIXMAN.fixed_t values in one" \
+    " pass, without executing any Python code per element. A NumPy array is flattened" \
+    " and converted using NumPy vector operations."
+    result = array.array(PIXMAN.fixed_t._type_)
+    if _is_ndarray(values) :
+        import numpy
+        result.frombytes \
+          (
+            numpy.rint(numpy.asarray(values, dtype = numpy.float64).ravel() * PIXMAN.fixed_1)
+                .astype(numpy.dtype(result.typecode))
+                .tobytes()
+          )
+    else :
+        result.extend(map(round, map(operator.mul, values, itertools.repeat(PIXMAN.fixed_1))))
+    #end if
+    return \
+        result
+#end doubles_to_fixed
+
+def fixed_to_doubles(values) :
+    "converts a sequence of PIXMAN.fixed_t values to an array.array of doubles in one" \
+    " pass, without executing any Python code per element. The result can be wrapped" \
+    " as a NumPy array without copying, with numpy.frombuffer(result)."
+    return \
+        array.array("d", map(operator.truediv, values, itertools.repeat(PIXMAN.fixed_1)))
+#end fixed_to_doubles
+
+def _rgba_array(rgba) :
+    # returns a NumPy rgba colour array as a float64 array of shape (n, 4),
+    # checking the values are in range.
+    import numpy
+    rgba = numpy.asarray(rgba, dtype = numpy.float64).reshape((-1, 4))
+    if ((rgba < 0) | (rgba > 1)).any() :
+        raise ValueError("colour components must be in [0, 1]")
+    #end if
+    return \
+        rgba
+#end _rgba_array
+
+def _rgba_iter(rgba) :
+    # generates premultiplied (r, g, b, a) tuples from a flat sequence of
+    # non-premultiplied components, checking they are in range.
+    rgba = iter(rgba)
+    for r, g, b, a in zip(rgba, rgba, rgba, rgba) :
+        if not (0 <= r <= 1 and 0 <= g <= 1 and 0 <= b <= 1 and 0 <= a <= 1) :
+            raise ValueError("colour components must be in [0, 1]")
+        #end if
+        yield r * a, g * a, b * a, a
+    #end for
+#end _rgba_iter
+
+def colours_to_pixman(rgba) :
+    "converts colours, given as a flat sequence of non-premultiplied r, g, b, a" \
+    " components in [0, 1], to premultiplied 16-bit PIXMAN.color_t form, in one pass." \
+    " The result is an array.array(\"H\") of red, green, blue, alpha values, with the" \
+    " same layout as an array of color_t, so (PIXMAN.color_t * n).from_buffer can" \
+    " wrap it without copying. If rgba is a NumPy array, it is converted using NumPy" \
+    " vector operations, and the result is a NumPy uint16 array of shape (n, 4)."
+    if _is_ndarray(rgba) :
+        import numpy
+        rgba = _rgba_array(rgba)
+        alpha = rgba[:, 3:4]
+        result = numpy.rint \
+          (
+            numpy.concatenate((rgba[:, :3] * alpha, alpha), axis = 1) * 65535
+          ).astype(numpy.uint16)
+    else :
+        result = array.array \
+          (
+            "H",
+            (
+                round(c * 65535)
+                for c in itertools.chain.from_iterable(_rgba_iter(rgba))
+            )
+          )
+    #end if
+    return \
+        result
+#end colours_to_pixman
+
+def colours_from_pixman(packed) :
+    "converts premultiplied 16-bit colours, given as a flat sequence of red, green," \
+    " blue, alpha values (e.g. an array of PIXMAN.color_t viewed as unsigned shorts)," \
+    " to an array.array of doubles of non-premultiplied r, g, b, a components, in one" \
+    " pass. Colours with zero alpha become (0, 0, 0, 0). If packed is a NumPy array," \
+    " the result is a NumPy float64 array of shape (n, 4)."
+    if _is_ndarray(packed) :
+        import numpy
+        packed = numpy.asarray(packed, dtype = numpy.float64).reshape((-1, 4)) / 65535
+        alpha = packed[:, 3:4]
+        result = numpy.zeros_like(packed)
+        numpy.divide(packed[:, :3], alpha, out = result[:, :3], where = alpha != 0)
+        result[:, 3:4] = alpha
+    else :
+        result = array.array("d")
+        packed = iter(packed)
+        for r, g, b, a in zip(packed, packed, packed, packed) :
+            if a != 0 :
+                result.extend((r / a, g / a, b / a, a / 65535))
+            else :
+                result.extend((0.0, 0.0, 0.0, 0.0))
+            #end if
+        #end for
+    #end if
+    return \
+        result
+#end colours_from_pixman
+
+def colours_to_pixels(rgba, format) :
+    "converts colours, given as a flat sequence of non-premultiplied r, g, b, a" \
+    " components in [0, 1], to premultiplied pixel values in the specified Pixman" \
+    " format, in one pass. The format must be an alpha-only or ARGB, ABGR, BGRA or" \
+    " RGBA format of at most 32 bits per pixel. The result is an array.array(\"I\")" \
+    " of pixel values, or a NumPy uint32 array if rgba is a NumPy array."
+    bpp = PIXMAN.FORMAT_BPP(format)
+    fmt_type = PIXMAN.FORMAT_TYPE(format)
+    a_bits, r_bits, g_bits, b_bits = \
+        (PIXMAN.FORMAT_A(format), PIXMAN.FORMAT_R(format), PIXMAN.FORMAT_G(format), PIXMAN.FORMAT_B(format))
+    if fmt_type == PIXMAN.TYPE_A :
+        shifts = (0, 0, 0, 0)
+    elif fmt_type == PIXMAN.TYPE_ARGB :
+        shifts = (g_bits + b_bits, b_bits, 0, r_bits + g_bits + b_bits)
+    elif fmt_type == PIXMAN.TYPE_ABGR :
+        shifts = (0, r_bits, r_bits + g_bits, r_bits + g_bits + b_bits)
+    elif fmt_type == PIXMAN.TYPE_BGRA :
+        shifts = (bpp - b_bits - g_bits - r_bits, bpp - b_bits - g_bits, bpp - b_bits, 0)
+    elif fmt_type == PIXMAN.TYPE_RGBA :
+        shifts = (bpp - r_bits, bpp - r_bits - g_bits, bpp - r_bits - g_bits - b_bits, 0)
+    else :
+        raise ValueError("unsupported format type %d" % fmt_type)
+    #end if
+    if bpp > 32 :
+        raise ValueError("unsupported pixel size %d" % bpp)
+    #end if
+    channels = tuple \
+      (
+        ((1 << bits) - 1, shift) # scale and shift for each channel, zero scale if absent
+        for bits, shift in zip((r_bits, g_bits, b_bits, a_bits), shifts)
+      )
+    if _is_ndarray(rgba) :
+        import numpy
+        rgba = _rgba_array(rgba)
+        premul = rgba * numpy.concatenate((rgba[:, 3:4].repeat(3, axis = 1), numpy.ones((len(rgba), 1))), axis = 1)
+        result = numpy.zeros(len(rgba), dtype = numpy.uint32)
+        for i, (scale, shift) in enumerate(channels) :
+            if scale != 0 :
+                result |= numpy.rint(premul[:, i] * scale).astype(numpy.uint32) << numpy.uint32(shift)
+            #end if
+        #end for
+    else :
+        (r_scale, r_shift), (g_scale, g_shift), (b_scale, b_shift), (a_scale, a_shift) = channels
+        result = array.array \
+          (
+            "I",
+            (
+                    round(r * r_scale) << r_shift
+                |
+                    round(g * g_scale) << g_shift
+                |
+                    round(b * b_scale) << b_shift
+                |
+                    round(a * a_scale) << a_shift
+                for r, g, b, a in _rgba_iter(rgba)
+            )
+          )
+    #end if
+    return \
+        result
+#end colours_to_pixels
+
+class Filter :
+    "a Pixman filter type together with associated coefficients, if any. Do not" \
+    " instantiate directly; use one of the create methods, or one of the predefined" \
+    " instances FAST, GOOD, BEST, NEAREST or BILINEAR.\n" \
+    "\n" \
+    "The parameters of a convolution filter are kept in an array.array of fixed-point" \
+    " values, exactly as passed to Pixman, and the arithmetic operations work on" \
+    " these directly, a whole row or array at a time."
+
+    __slots__ = ("_type", "_values") # to forestall typos
+
+    def __init__(self, _type, _values) :
+        self._type = _type
+        self._values = _values # array.array of PIXMAN.fixed_t, or None
+    #end __init__
+
+    def _to_pixman(self) :
+        # returns the address and number of the parameter values to pass to Pixman.
         if self._values != None :
-            libc.free(self._values)
-            self._values = None
+            result = self._values.buffer_info()
+        else :
+            result = (None, 0)
         #end if
-    #end __del__
+        return \
+            result
+    #end _to_pixman
+
+    @property
+    def values(self) :
+        "a copy of the complete parameter array for this Filter, as passed to Pixman," \
+        " in the form of an array.array of PIXMAN.fixed_t values. Empty for filter" \
+        " types that take no parameters."
+        return \
+            array.array(PIXMAN.fixed_t._type_, self._values or ())
+    #end values
+
+    @staticmethod
+    def _create_convolution_fixed(dimensions, fixed) :
+        # creates a convolution filter from an array.array of fixed-point coefficients.
+        width, height = dimensions
+        values = array.array(PIXMAN.fixed_t._type_, (PIXMAN.int_to_fixed(width), PIXMAN.int_to_fixed(height)))
+        values.extend(fixed)
+        assert len(values) == width * height + 2
+        return \
+            Filter(PIXMAN.FILTER_CONVOLUTION, values)
+    #end _create_convolution_fixed
 
     @staticmethod
     def create_convolution(dimensions, coeffs) :
         "creates a general convolution filter from a dimensions.x * dimensions.y array" \
-        " of coefficients. The dimensions must be odd."
+        " of coefficients. The dimensions must be odd. coeffs may be any sequence of" \
+        " reals, including an array.array or a NumPy array, which are converted to" \
+        " fixed-point in bulk."
         width, height = Point.from_tuple(dimensions).assert_isshortint()
         if width % 2 == 0 or height % 2 == 0 :
             raise ValueError("dimensions must be odd")
         #end if
-        nr_coeffs = len(coeffs)
-        assert width > 0 and height > 0 and nr_coeffs == width * height
-        c_values = libc.malloc((nr_coeffs + 2) * ct.sizeof(PIXMAN.fixed_t))
-        if c_values == None :
-            raise MemoryError("unable to allocate filter array")
-        #end if
-        cc_values = ct.cast(c_values, PIXMAN.fixed_t_ptr)
-        cc_values[0] = PIXMAN.int_to_fixed(width)
-        cc_values[1] = PIXMAN.int_to_fixed(height)
-        for i in range(nr_coeffs) :
-            cc_values[i + 2] = PIXMAN.double_to_fixed(coeffs[i])
-        #end for
+        fixed = doubles_to_fixed(coeffs)
+        assert width > 0 and height > 0 and len(fixed) == width * height
         return \
-            Filter(PIXMAN.FILTER_CONVOLUTION, c_values, nr_coeffs + 2)
+            Filter._create_convolution_fixed((width, height), fixed)
     #end create_convolution
 
-    @property
-    def params(self) :
-        "returns a tuple of (dimensions, coeffs) for a convolution Filter."
+    def _convolution_fixed(self) :
+        # returns the dimensions and fixed-point coefficients of a convolution Filter.
         if self._type != PIXMAN.FILTER_CONVOLUTION :
             raise ValueError("only defined for convolution Filter")
         #end if
-        assert self._nr_values >= 2
-        params = ct.cast(self._values, PIXMAN.fixed_t_ptr)
+        params = self._values
+        assert len(params) >= 2
         width = params[0] >> 16
         height = params[1] >> 16
-        assert self._nr_values == width * height + 2
-        coeffs = []
-        offs = 1
-        for i in range(height) :
-            for j in range(width) :
-                offs += 1
-                coeffs.append(PIXMAN.fixed_to_double(params[offs]))
-            #end for
-        #end for
+        assert len(params) == width * height + 2
+        return \
+            (Point(width, height), params[2:])
+    #end _convolution_fixed
+
+    @property
+    def params(self) :
+        "returns a tuple of (dimensions, coeffs) for a convolution Filter, where coeffs" \
+        " is an array.array of doubles in row-major order."
+        dimensions, fixed = self._convolution_fixed()
         return \
-            (Point(width, height), coeffs)
+            (dimensions, fixed_to_doubles(fixed))
     #end params
 
     @staticmethod
-    def create_resampler(scale, reconstruct, sample, subsample_bits) :
+    def create_resampler(scale, reconstruct, sample, subsample_bits, cached = True) :
         "creates a specific form of separable convolution filter (as a higher-quality" \
         " way of resampling images than the non-convolution filters) from the" \
         " specified settings: scale is a Point, reconstruct and sample are pairs" \
         " of PIXMAN.KERNEL_xxx values, and subsample_bits is a pair of integer number" \
-        " of bits to shift for subpixel sampling."
+        " of bits to shift for subpixel sampling.\n" \
+        "\n" \
+        "If cached, then identical resamplers are shared through Filter.resampler_cache," \
+        " an LRUCache with a budget in bytes of filter parameters, instead of being" \
+        " regenerated each time."
         scale = Point.from_tuple(scale).to_pixman_fixed()
         subsample_bits = Point.from_tuple(subsample_bits).assert_isint()
-        n_values = ct.c_int()
-        values = pixman.pixman_filter_create_separable_convolution \
-          (
-            ct.byref(n_values),
-            scale.x,
-            scale.y,
-            reconstruct[0],
-            reconstruct[1],
-            sample[0],
-            sample[1],
-            subsample_bits.x,
-            subsample_bits.y,
-          )
-        if values == None :
-            raise MemoryError("unable to allocate separable convolution filter")
+        if cached :
+            result = Filter.resampler_cache.get \
+              (
+                (
+                    scale.x,
+                    scale.y,
+                    reconstruct[0],
+                    reconstruct[1],
+                    sample[0],
+                    sample[1],
+                    subsample_bits.x,
+                    subsample_bits.y,
+                ),
+                lambda :
+                    Filter.create_resampler
+                      (
+                        scale = Point.from_pixman_fixed(scale),
+                        reconstruct = reconstruct,
+                        sample = sample,
+                        subsample_bits = subsample_bits,
+                        cached = False
+                      )
+              )
+        else :
+            n_values = ct.c_int()
+            c_values = pixman.pixman_filter_create_separable_convolution \
+              (
+                ct.byref(n_values),
+                scale.x,
+                scale.y,
+                reconstruct[0],
+                reconstruct[1],
+                sample[0],
+                sample[1],
+                subsample_bits.x,
+                subsample_bits.y,
+              )
+            if c_values == None :
+                raise MemoryError("unable to allocate separable convolution filter")
+            #end if
+            values = array.array(PIXMAN.fixed_t._type_)
+            values.frombytes(ct.string_at(c_values, n_values.value * ct.sizeof(PIXMAN.fixed_t)))
+            libc.free(c_values)
+            result = Filter(PIXMAN.FILTER_SEPARABLE_CONVOLUTION, values)
         #end if
         return \
-            Filter(PIXMAN.FILTER_SEPARABLE_CONVOLUTION, values, n_values.value)
+            result
     #end create_resampler
 
     @staticmethod
-    def create_convolution_from_function(func, radius, gain = 1.0, peak = None, clip_peak = True) :
+    def create_separable(x_kernel, y_kernel, phase_bits = (0, 0)) :
+        "creates a separable convolution filter from arbitrary 1-dimensional kernels," \
+        " costing width + height multiplications per pixel instead of the width * height" \
+        " of an equivalent general convolution. phase_bits is an integer Point giving" \
+        " the number of bits of subpixel position to distinguish in each direction." \
+        " Each kernel may be a single sequence of reals, which is used for all" \
+        " 1 << phase_bits subpixel phases in that direction, or a sequence of" \
+        " 1 << phase_bits sequences of equal length, one per phase."
+        phase_bits = Point.from_tuple(phase_bits).assert_isint()
+        if phase_bits.x < 0 or phase_bits.y < 0 or phase_bits.x > 16 or phase_bits.y > 16 :
+            raise ValueError("phase_bits must be in [0 .. 16]")
+        #end if
+
+        def kernel_fixed(kernel, nr_bits) :
+            nr_phases = 1 << nr_bits
+            kernel = list(kernel)
+            if len(kernel) == 0 :
+                raise ValueError("kernel must not be empty")
+            #end if
+            if isinstance(kernel[0], Real) :
+                fixed = doubles_to_fixed(kernel)
+                length = len(fixed)
+                fixed *= nr_phases
+            else :
+                if len(kernel) != nr_phases :
+                    raise ValueError("need %d kernel phases, not %d" % (nr_phases, len(kernel)))
+                #end if
+                fixed = array.array(PIXMAN.fixed_t._type_)
+                length = None
+                for phase in kernel :
+                    phase = doubles_to_fixed(phase)
+                    if length == None :
+                        length = len(phase)
+                    elif len(phase) != length :
+                        raise ValueError("all kernel phases must be the same length")
+                    #end if
+                    fixed.extend(phase)
+                #end for
+            #end if
+            if length == 0 or not qah.int_fits_bits(length, 16) :
+                raise ValueError("invalid kernel length %d" % length)
+            #end if
+            return \
+                length, fixed
+        #end kernel_fixed
+
+    #begin create_separable
+        width, x_fixed = kernel_fixed(x_kernel, phase_bits.x)
+        height, y_fixed = kernel_fixed(y_kernel, phase_bits.y)
+        values = array.array \
+          (
+            PIXMAN.fixed_t._type_,
+            map(PIXMAN.int_to_fixed, (width, height, phase_bits.x, phase_bits.y))
+          )
+        values.extend(x_fixed)
+        values.extend(y_fixed)
+        return \
+            Filter(PIXMAN.FILTER_SEPARABLE_CONVOLUTION, values)
+    #end create_separable
+
+    @staticmethod
+    def create_convolution_from_function(func, radius, gain = 1.0, peak = None, clip_peak = True, separable = False) :
         "creates a convolution filter with coefficients given by evaluating the" \
         " specified function. func is a function of two real arguments (x, y) each in" \
         " [-1, +1]. radius is an integer Point so that the number of coefficients" \
@@ -1295,7 +2501,8 @@ class Filter :
         " If gain is None, no scaling will be applied. peak, if not None, is the" \
         " special-case coefficient for the original pixel coordinate, otherwise if None," \
         " the function value is used. if clip_peak, then the peak is included in the gain" \
-        " scaling; otherwise it is not."
+        " scaling; otherwise it is not. If separable, then the result is converted to" \
+        " a separable convolution filter if the coefficients allow (see to_separable)."
         radius = math.ceil(Point.from_tuple(radius))
         coeffs = []
         total = 0.0
@@ -1325,21 +2532,90 @@ class Filter :
                 #end for
             #end for
         #end if
+        result = Filter.create_convolution((2 * radius.x + 1, 2 * radius.y + 1), coeffs)
+        if separable :
+            result = result.to_separable()
+        #end if
         return \
-            Filter.create_convolution((2 * radius.x + 1, 2 * radius.y + 1), coeffs)
+            result
     #end create_convolution_from_function
 
+    def separable_factors(self, tolerance = 2 / PIXMAN.fixed_1) :
+        "this Filter must be a convolution filter. If its coefficient matrix is (within" \
+        " tolerance) the outer product of a column and a row, i.e. it has rank 1, returns" \
+        " a tuple (x_kernel, y_kernel) of array.arrays of doubles such that each" \
+        " coefficient [y, x] is y_kernel[y] * x_kernel[x]. Otherwise returns None." \
+        " x_kernel is scaled to sum to 1 where possible, so y_kernel carries the gain."
+        dimensions, fixed = self._convolution_fixed()
+        coeffs = fixed_to_doubles(fixed)
+        width = dimensions.x
+        # use the largest-magnitude coefficient as the pivot: its row and column
+        # determine the only possible factorization.
+        pivot = max(range(len(coeffs)), key = lambda i : abs(coeffs[i]))
+        pivot_value = coeffs[pivot]
+        if pivot_value == 0 :
+            x_kernel = array.array("d", (0.0,)) * dimensions.x
+            y_kernel = array.array("d", (0.0,)) * dimensions.y
+        else :
+            prow, pcol = divmod(pivot, width)
+            x_kernel = array.array("d", (c / pivot_value for c in coeffs[prow * width : (prow + 1) * width]))
+            y_kernel = array.array("d", coeffs[pcol::width])
+            x_sum = sum(x_kernel)
+            if abs(x_sum) > tolerance :
+                x_kernel = array.array("d", (c / x_sum for c in x_kernel))
+                y_kernel = array.array("d", (c * x_sum for c in y_kernel))
+            #end if
+        #end if
+        for row in range(dimensions.y) :
+            ycoeff = y_kernel[row]
+            if any \
+              (
+                abs(c - ycoeff * xcoeff) > tolerance
+                for c, xcoeff in zip(coeffs[row * width : (row + 1) * width], x_kernel)
+              ) \
+            :
+                result = None
+                break
+            #end if
+        else :
+            result = (x_kernel, y_kernel)
+        #end for
+        return \
+            result
+    #end separable_factors
+
+    def to_separable(self, tolerance = 2 / PIXMAN.fixed_1) :
+        "returns an equivalent separable convolution filter if this is a convolution" \
+        " filter whose coefficients can be factorized (see separable_factors), otherwise" \
+        " returns this Filter unchanged."
+        if self._type == PIXMAN.FILTER_CONVOLUTION :
+            factors = self.separable_factors(tolerance)
+        else :
+            factors = None
+        #end if
+        if factors != None :
+            result = Filter.create_separable(*factors)
+        else :
+            result = self
+        #end if
+        return \
+            result
+    #end to_separable
+
+    # Note that the arithmetic operations below work directly on the fixed-point
+    # coefficients. Because conversions between doubles and fixed-point only scale
+    # by a power of 2, the results are identical to converting to doubles, doing
+    # the arithmetic and converting back.
+
     def __add__(f1, f2) :
         "addition of corresponding coefficients of two convolution filters."
         if f1._type == PIXMAN.FILTER_CONVOLUTION and isinstance(f2, Filter) and f2._type == PIXMAN.FILTER_CONVOLUTION :
-            params1 = f1.params
-            params2 = f2.params
-            dimensions = params1[0]
-            if dimensions != params2[0] :
+            dimensions, fixed1 = f1._convolution_fixed()
+            dimensions2, fixed2 = f2._convolution_fixed()
+            if dimensions != dimensions2 :
                 raise ValueError("convolution kernels must have same dimensions")
             #end if
-            coeffs = list(params1[1][i] + params2[1][i] for i in range(dimensions.x * dimensions.y))
-            result = Filter.create_convolution(dimensions, coeffs)
+            result = Filter._create_convolution_fixed(dimensions, map(operator.add, fixed1, fixed2))
         else :
             result = NotImplemented
         #end if
@@ -1350,14 +2626,12 @@ class Filter :
     def __sub__(f1, f2) :
         "subtraction of corresponding coefficients of two convolution filters."
         if f1._type == PIXMAN.FILTER_CONVOLUTION and isinstance(f2, Filter) and f2._type == PIXMAN.FILTER_CONVOLUTION :
-            params1 = f1.params
-            params2 = f2.params
-            dimensions = params1[0]
-            if dimensions != params2[0] :
+            dimensions, fixed1 = f1._convolution_fixed()
+            dimensions2, fixed2 = f2._convolution_fixed()
+            if dimensions != dimensions2 :
                 raise ValueError("convolution kernels must have same dimensions")
             #end if
-            coeffs = list(params1[1][i] - params2[1][i] for i in range(dimensions.x * dimensions.y))
-            result = Filter.create_convolution(dimensions, coeffs)
+            result = Filter._create_convolution_fixed(dimensions, map(operator.sub, fixed1, fixed2))
         else :
             result = NotImplemented
         #end if
@@ -1368,15 +2642,14 @@ class Filter :
     def __neg__(self) :
         "unary negation of convolution filter components."
         if self._type == PIXMAN.FILTER_CONVOLUTION :
-            dimensions, coeffs = self.params
-            coeffs = list(- coeffs[i] for i in range(dimensions.x * dimensions.y))
-            result = Filter.create_convolution(dimensions, coeffs)
+            dimensions, fixed = self._convolution_fixed()
+            result = Filter._create_convolution_fixed(dimensions, map(operator.neg, fixed))
         else :
             raise NotImplementedError
         #end if
         return \
             result
-    #end __neg_-
+    #end __neg__
 
     def __pos__(self) :
         return \
@@ -1386,9 +2659,12 @@ class Filter :
     def __mul__(self, factor) :
         "multiplication of the coefficients of a convolution filter by a scalar."
         if self._type == PIXMAN.FILTER_CONVOLUTION and isinstance(factor, Real) :
-            dimensions, coeffs = self.params
-            coeffs = list(coeffs[i] * factor for i in range(dimensions.x * dimensions.y))
-            result = Filter.create_convolution(dimensions, coeffs)
+            dimensions, fixed = self._convolution_fixed()
+            result = Filter._create_convolution_fixed \
+              (
+                dimensions,
+                map(round, map(operator.mul, fixed, itertools.repeat(factor)))
+              )
         else :
             result = NotImplemented
         #end if
@@ -1400,9 +2676,12 @@ class Filter :
     def __truediv__(self, factor) :
         "division of the coefficients of a convolution filter by a scalar."
         if self._type == PIXMAN.FILTER_CONVOLUTION and isinstance(factor, Real) :
-            dimensions, coeffs = self.params
-            coeffs = list(coeffs[i] / factor for i in range(dimensions.x * dimensions.y))
-            result = Filter.create_convolution(dimensions, coeffs)
+            dimensions, fixed = self._convolution_fixed()
+            result = Filter._create_convolution_fixed \
+              (
+                dimensions,
+                map(round, map(operator.truediv, fixed, itertools.repeat(factor)))
+              )
         else :
             result = NotImplemented
         #end if
@@ -1414,24 +2693,19 @@ class Filter :
         "this Filter must be a convolution filter, and steps must be an integer Point" \
         " giving the number of row and column steps. The result is a new Filter with the" \
         " coefficients moved by the specified offsets."
-        if self._type != PIXMAN.FILTER_CONVOLUTION :
-            raise ValueError("only defined for convolution Filter")
-        #end if
         steps = Point.from_tuple(steps).assert_isint()
-        old_dims, old_coeffs = self.params
+        old_dims, old_fixed = self._convolution_fixed()
         new_dims = old_dims + 2 * Point(abs(steps.x), abs(steps.y))
         # might be useful to look for rows/columns of all-zero coeffs at opposite
         # edges from steps (e.g. added as a result of a previous offset operation in the
         # opposite direction) and discard them.
-        new_coeffs = [0] * new_dims.x * new_dims.y
+        new_fixed = array.array(PIXMAN.fixed_t._type_, bytes(new_dims.x * new_dims.y * ct.sizeof(PIXMAN.fixed_t)))
         for i in range(old_dims.y) :
-            for j in range(old_dims.x) :
-                new_coeffs[(i + 2 * max(steps.y, 0)) * new_dims.x + j + 2 * max(steps.x, 0)] = \
-                    old_coeffs[i * old_dims.x + j]
-            #end for
+            new_offs = (i + 2 * max(steps.y, 0)) * new_dims.x + 2 * max(steps.x, 0)
+            new_fixed[new_offs : new_offs + old_dims.x] = old_fixed[i * old_dims.x : (i + 1) * old_dims.x]
         #end for
         return \
-            Filter.create_convolution(new_dims, new_coeffs)
+            Filter._create_convolution_fixed(new_dims, new_fixed)
     #end offset
 
     def resize(self, dimensions, value = 0.0) :
@@ -1439,36 +2713,28 @@ class Filter :
         " giving the new Filter dimensions. The result is a new Filter containing a copy" \
         " of the coefficients with thins one, but with the specified number of coefficient" \
         " rows and columns added or subtracted. Added coefficients are initialized to value."
-        if self._type != PIXMAN.FILTER_CONVOLUTION :
-            raise ValueError("only defined for convolution Filter")
-        #end if
-        old_dimensions, old_coeffs = self.params
+        old_dimensions, old_fixed = self._convolution_fixed()
         dimensions = Point.from_tuple(dimensions).assert_isint()
         assert dimensions.x > 0 and dimensions.y > 0
-        coeffs = [value] * dimensions.x * dimensions.y
+        fixed = array.array(PIXMAN.fixed_t._type_, (PIXMAN.double_to_fixed(value),)) * (dimensions.x * dimensions.y)
+        nr_cols = min(old_dimensions.x, dimensions.x)
         for i in range(min(old_dimensions.y, dimensions.y)) :
-            for j in range(min(old_dimensions.x, dimensions.x)) :
-                    coeffs \
-                        [
-                            (i + max((dimensions.y - old_dimensions.y) // 2, 0)) * dimensions.x
-                        +
-                            j
-                        +
-                            max((dimensions.x - old_dimensions.x) // 2, 0)
-                        ] \
-                = \
-                    old_coeffs \
-                        [
-                            (i + max((old_dimensions.y - dimensions.y) // 2, 0)) * old_dimensions.x
-                        +
-                            j
-                        +
-                            max((old_dimensions.x - dimensions.x) // 2, 0)
-                        ]
-            #end for
+            offs = \
+                (
+                    (i + max((dimensions.y - old_dimensions.y) // 2, 0)) * dimensions.x
+                +
+                    max((dimensions.x - old_dimensions.x) // 2, 0)
+                )
+            old_offs = \
+                (
+                    (i + max((old_dimensions.y - dimensions.y) // 2, 0)) * old_dimensions.x
+                +
+                    max((old_dimensions.x - dimensions.x) // 2, 0)
+                )
+            fixed[offs : offs + nr_cols] = old_fixed[old_offs : old_offs + nr_cols]
         #end for
         return \
-            Filter.create_convolution(dimensions, coeffs)
+            Filter._create_convolution_fixed(dimensions, fixed)
     #end resize
 
     def clip(self, fmin = None, fmax = None) :
@@ -1487,12 +2753,12 @@ class Filter :
         ) :
             raise TypeError("fmin and fmax must be convolution Filters or None")
         #end if
-        dimensions, coeffs = self.params
+        dimensions, fixed = self._convolution_fixed()
         if fmin != None :
-            dimensions_min, coeffs_min = fmin.params
+            dimensions_min, fixed_min = fmin._convolution_fixed()
         #end if
         if fmax != None :
-            dimensions_max, coeffs_max = fmax.params
+            dimensions_max, fixed_max = fmax._convolution_fixed()
         #end if
         if (
                 fmin != None and dimensions_min != dimensions
@@ -1501,22 +2767,38 @@ class Filter :
         ) :
             raise ValueError("fmin and fmax, if specified, must have same dimensions as this Filter")
         #end if
-        for i in range(dimensions.y) :
-            for j in range(dimensions.x) :
-                coeff = coeffs[i * dimensions.x + j]
-                if fmin != None :
-                    coeff = max(coeffs_min[i * dimensions.x + j], coeff)
-                #end if
-                if fmax != None :
-                    coeff = min(coeffs_max[i * dimensions.x + j], coeff)
-                #end if
-                coeffs[i * dimensions.x + j] = coeff
-            #end for
-        #end for
+        if fmin != None :
+            fixed = array.array(PIXMAN.fixed_t._type_, map(max, fixed_min, fixed))
+        #end if
+        if fmax != None :
+            fixed = array.array(PIXMAN.fixed_t._type_, map(min, fixed_max, fixed))
+        #end if
         return \
-            Filter.create_convolution(dimensions, coeffs)
+            Filter._create_convolution_fixed(dimensions, fixed)
     #end clip
 
+    @property
+    def halo(self) :
+        "returns an integer Point giving the number of pixels beyond each destination" \
+        " pixel, in each direction, that this Filter reads from the source image when" \
+        " it is applied with the identity transform."
+        if self._type in (PIXMAN.FILTER_CONVOLUTION, PIXMAN.FILTER_SEPARABLE_CONVOLUTION) :
+            width = self._values[0] >> 16
+            height = self._values[1] >> 16
+            result = Point(width // 2, height // 2)
+            if self._type == PIXMAN.FILTER_SEPARABLE_CONVOLUTION :
+                # allow for rounding to subpixel phases
+                result += Point(1, 1)
+            #end if
+        elif self._type in (PIXMAN.FILTER_FAST, PIXMAN.FILTER_NEAREST) :
+            result = Point(0, 0)
+        else :
+            result = Point(1, 1)
+        #end if
+        return \
+            result
+    #end halo
+
     def __repr__(self) :
         "returns a human-readable representation of this Filter."
         assert \
@@ -1526,59 +2808,46 @@ class Filter :
                 (self._type in (PIXMAN.FILTER_SEPARABLE_CONVOLUTION, PIXMAN.FILTER_CONVOLUTION))
             )
         if self._type == PIXMAN.FILTER_CONVOLUTION :
-            assert self._nr_values >= 2
-            params = ct.cast(self._values, PIXMAN.fixed_t_ptr)
-            width = params[0] >> 16
-            height = params[1] >> 16
-            assert self._nr_values == width * height + 2
-            display = ""
-            offs = 1
-            for i in range(height) :
-                if i != 0 :
-                    display += ", "
-                #end if
-                display += "("
-                for j in range(width) :
-                    if j != 0 :
-                        display += ", "
-                    #end if
-                    offs += 1
-                    display += "%g" % PIXMAN.fixed_to_double(params[offs])
-                #end for
-                display += ")"
-            #end for
-            result = "Filter.CONVOLUTION(%d × %d, (%s))" % (width, height, display)
+            (width, height), coeffs = self.params
+            result = \
+                (
+                    "Filter.CONVOLUTION(%d × %d, (%s))"
+                %
+                    (
+                        width,
+                        height,
+                        ", ".join
+                          (
+                            "(%s)" % ", ".join("%g" % c for c in coeffs[i * width : (i + 1) * width])
+                            for i in range(height)
+                          ),
+                    )
+                )
         elif self._type == PIXMAN.FILTER_SEPARABLE_CONVOLUTION :
-            assert self._nr_values >= 4
-            params = ct.cast(self._values, PIXMAN.fixed_t_ptr)
+            params = self._values
+            assert len(params) >= 4
             width = params[0] >> 16
             height = params[1] >> 16
             x_phase_bits = params[2] >> 16
             y_phase_bits = params[3] >> 16
             nr_x_phases = 1 << x_phase_bits
             nr_y_phases = 1 << y_phase_bits
-            assert self._nr_values == 4 + width * nr_x_phases + height * nr_y_phases
-            display = ""
-            offs = 3
-            doing_height = False
-            while True :
-                display += "("
-                for i in range((width, height)[doing_height]) :
-                    if i != 0 :
-                        display += ", "
-                    #end if
-                    offs += 1
-                    display += "%g" % PIXMAN.fixed_to_double(params[offs])
-                #end for
-                display += ")"
-                if doing_height :
-                    break
-                display += ", "
-                doing_height = True
-            #end while
+            assert len(params) == 4 + width * nr_x_phases + height * nr_y_phases
+            # only shows coefficients for first phase in each direction
+            x_coeffs = fixed_to_doubles(params[4 : 4 + width])
+            y_offs = 4 + width * nr_x_phases
+            y_coeffs = fixed_to_doubles(params[y_offs : y_offs + height])
+            display = \
+                (
+                    "(%s), (%s)"
+                %
+                    (
+                        ", ".join("%g" % c for c in x_coeffs),
+                        ", ".join("%g" % c for c in y_coeffs),
+                    )
+                )
             result = "Filter.SEPARABLE_CONVOLUTION(%d × %d, (1 << %d) × (1 << %d), %s)" % (width, height, x_phase_bits, y_phase_bits, display)
         else :
-            assert self._nr_values == 0
             result = \
                 (
                     "Filter."
@@ -1598,11 +2867,16 @@ class Filter :
 
 #end Filter
 # predefined filters:
-Filter.FAST = Filter(PIXMAN.FILTER_FAST, None, 0)
-Filter.GOOD = Filter(PIXMAN.FILTER_GOOD, None, 0)
-Filter.BEST = Filter(PIXMAN.FILTER_BEST, None, 0)
-Filter.NEAREST = Filter(PIXMAN.FILTER_NEAREST, None, 0)
-Filter.BILINEAR = Filter(PIXMAN.FILTER_BILINEAR, None, 0)
+Filter.FAST = Filter(PIXMAN.FILTER_FAST, None)
+Filter.GOOD = Filter(PIXMAN.FILTER_GOOD, None)
+Filter.BEST = Filter(PIXMAN.FILTER_BEST, None)
+Filter.NEAREST = Filter(PIXMAN.FILTER_NEAREST, None)
+Filter.BILINEAR = Filter(PIXMAN.FILTER_BILINEAR, None)
+Filter.resampler_cache = LRUCache \
+  (
+    max_size = 4 << 20,
+    size_of = lambda f : len(f._values) * ct.sizeof(PIXMAN.fixed_t)
+  )
 
 def blt(src_bits, dst_bits, src_stride, dst_stride, src_bpp, dst_bpp, src_pos, dest_pos, dimensions) :
     "low-level blit routine. returns success/failure (i.e. unsupported format)."
@@ -1619,6 +2893,149 @@ def fill(bits, stride, bpp, pos, dimensions, filler) :
         pixman.pixman_fill(bits, stride, bpp, pos.x, pos.y, dimensions.x, dimensions.y, filler)
 #end fill
 
+class ShapeList :
+    "base class for array-backed lists of Pixman shapes. Do not instantiate directly;" \
+    " use one of the subclasses Trapezoids, Traps or Triangles.\n" \
+    "\n" \
+    "The shapes are kept in the fixed property, an array.array of PIXMAN.fixed_t" \
+    " values, with each shape taking up a record of record_len consecutive values" \
+    " laid out exactly as in the corresponding Pixman structure. This lets the whole" \
+    " list be passed to Pixman without constructing a ctypes object for every shape."
+
+    __slots__ = ("fixed",) # to forestall typos
+
+    record_len = None # overridden by subclass
+    pixman_type = None # overridden by subclass
+
+    def __init__(self, fixed = None) :
+        if fixed is None :
+            fixed = array.array(PIXMAN.fixed_t._type_)
+        elif not isinstance(fixed, array.array) or fixed.typecode != PIXMAN.fixed_t._type_ :
+            # copy from any other buffer or sequence of integers
+            values = _int32_view(fixed)
+            fixed = array.array(PIXMAN.fixed_t._type_)
+            fixed.frombytes(values.cast("B"))
+        #end if
+        if len(fixed) % self.record_len != 0 :
+            raise ValueError("number of values must be a multiple of %d" % self.record_len)
+        #end if
+        self.fixed = fixed
+    #end __init__
+
+    @classmethod
+    def from_fixed(celf, fixed) :
+        "creates a list from a flat sequence of values already in Pixman fixed-point" \
+        " format. An array.array of the right type is used directly without copying;" \
+        " the contents of any other buffer of integers are copied, with a check that" \
+        " they fit in 32 bits."
+        return \
+            celf(fixed)
+    #end from_fixed
+
+    @classmethod
+    def from_values(celf, values) :
+        "creates a list from a flat sequence of real pixel coordinates, record_len per" \
+        " shape, in the same order as the fields of the Pixman structure."
+        return \
+            celf().extend_values(values)
+    #end from_values
+
+    def extend_values(self, values) :
+        "appends shapes given as a flat sequence of real pixel coordinates."
+        fixed = doubles_to_fixed(values)
+        if len(fixed) % self.record_len != 0 :
+            raise ValueError("number of values must be a multiple of %d" % self.record_len)
+        #end if
+        self.fixed.extend(fixed)
+        return \
+            self
+    #end extend_values
+
+    def __len__(self) :
+        "the number of shapes in the list."
+        return \
+            len(self.fixed) // self.record_len
+    #end __len__
+
+    def __getitem__(self, i) :
+        "returns a copy of the specified shape as a Pixman structure."
+        if not 0 <= i < len(self) :
+            raise IndexError("%s index out of range" % type(self).__name__)
+        #end if
+        offset = i * self.record_len
+        return \
+            self.pixman_type.from_buffer_copy(self.fixed[offset : offset + self.record_len])
+    #end __getitem__
+
+    def __repr__(self) :
+        return \
+            "%s.from_values(%s)" % (type(self).__name__, repr(fixed_to_doubles(self.fixed).tolist()))
+    #end __repr__
+
+    def _to_pixman(self) :
+        # returns the address of the array to pass to Pixman, and the number of shapes.
+        address, length = self.fixed.buffer_info()
+        return \
+            address, length // self.record_len
+    #end _to_pixman
+
+#end ShapeList
+
+class Trapezoids(ShapeList) :
+    "an array-backed list of Pixman trapezoids. Each trapezoid has a top and bottom" \
+    " y-coordinate, and left and right edges, each being a line through two Points" \
+    " (which need not lie between top and bottom)."
+
+    __slots__ = () # to forestall typos
+
+    record_len = 10
+    pixman_type = PIXMAN.trapezoid_t
+
+    def append(self, top, bottom, left, right) :
+        "appends a trapezoid. left and right are each a pair of Points."
+        (l1, l2), (r1, r2) = left, right
+        l1, l2, r1, r2 = (Point.from_tuple(p) for p in (l1, l2, r1, r2))
+        return \
+            self.extend_values((top, bottom, l1.x, l1.y, l2.x, l2.y, r1.x, r1.y, r2.x, r2.y))
+    #end append
+
+#end Trapezoids
+
+class Traps(ShapeList) :
+    "an array-backed list of Pixman traps. Each trap consists of a top and a bottom" \
+    " horizontal span, each given as a triple (l, r, y) of the left and right" \
+    " x-coordinates and the y-coordinate of the span."
+
+    __slots__ = () # to forestall typos
+
+    record_len = 6
+    pixman_type = PIXMAN.trap_t
+
+    def append(self, top, bot) :
+        "appends a trap. top and bot are each an (l, r, y) triple."
+        return \
+            self.extend_values(tuple(top) + tuple(bot))
+    #end append
+
+#end Traps
+
+class Triangles(ShapeList) :
+    "an array-backed list of Pixman triangles, each defined by three Points."
+
+    __slots__ = () # to forestall typos
+
+    record_len = 6
+    pixman_type = PIXMAN.triangle_t
+
+    def append(self, p1, p2, p3) :
+        "appends a triangle with the specified vertices."
+        p1, p2, p3 = (Point.from_tuple(p) for p in (p1, p2, p3))
+        return \
+            self.extend_values((p1.x, p1.y, p2.x, p2.y, p3.x, p3.y))
+    #end append
+
+#end Triangles
+
 class Image :
     "wrapper for a Pixman image. Do not instantiate directly; use the create methods.\n" \
     "\n" \
@@ -1642,6 +3059,17 @@ class Image :
             "_wrap_destroy_func",
             "_wrap_memory_read_func",
             "_wrap_memory_write_func",
+            # copies of clipping-related settings, which Pixman provides
+            # no way to query, for compute_composite_region:
+            "_clip_region",
+            "_clip_sources",
+            "_client_clip",
+            "_alpha_map",
+            "_alpha_origin",
+            # span callbacks for staged images:
+            "_read_span",
+            "_write_span",
+            "_palette", # Pixman does not copy it
         ) # to forestall typos
 
     def __init__(self, _pmobj) :
@@ -1655,6 +3083,14 @@ class Image :
         self._wrap_destroy_func = None
         self._wrap_memory_read_func = None
         self._wrap_memory_write_func = None
+        self._clip_region = None
+        self._clip_sources = False
+        self._client_clip = False
+        self._alpha_map = None
+        self._alpha_origin = None
+        self._read_span = None
+        self._write_span = None
+        self._palette = None
     #end __init__
 
     def __del__(self) :
@@ -1746,6 +3182,90 @@ class Image :
             result
     #end create_for_array
 
+    @staticmethod
+    def create_for_buffer(format, dimensions, buf, stride = None) :
+        "creates an Image whose pixels reside in buf, which may be any object" \
+        " exporting a contiguous, writable buffer, such as a bytearray, an mmap," \
+        " a NumPy array or the buf of a multiprocessing.shared_memory.SharedMemory." \
+        " format is a Pixman format code, dimensions is an integer Point specifying" \
+        " the dimensions of the image, and stride specifies how many bytes each row" \
+        " of the image occupies; if None, it defaults to format_stride(format, width)." \
+        " The Image holds an export of the buffer for as long as it exists, which" \
+        " keeps the pixels valid (and prevents resizing a bytearray or closing an mmap)."
+        width, height = Point.from_tuple(dimensions).assert_isint()
+        min_stride = format_stride(format, width)
+        if stride == None :
+            stride = min_stride
+        elif stride < min_stride or stride % 4 != 0 :
+            raise ValueError \
+              (
+                "stride must be a multiple of 4 no less than %d for this format and width" % min_stride
+              )
+        #end if
+        pixels = memoryview(buf)
+        if pixels.readonly :
+            raise TypeError("buffer must be writable")
+        #end if
+        if not pixels.c_contiguous :
+            raise ValueError("buffer must be contiguous")
+        #end if
+        pixels = pixels.cast("B")
+        if pixels.nbytes < height * stride :
+            raise ValueError("buffer must be at least %d bytes" % (height * stride))
+        #end if
+        c_pixels = (ct.c_ubyte * pixels.nbytes).from_buffer(pixels)
+        address = ct.addressof(c_pixels)
+        if address % 4 != 0 :
+            raise ValueError("buffer must be aligned to a multiple of 4 bytes")
+        #end if
+        result = Image(pixman.pixman_image_create_bits_no_clear(format, width, height, address, stride))
+        result._arr = c_pixels # to ensure it doesn't go away prematurely
+        return \
+            result
+    #end create_for_buffer
+
+    @staticmethod
+    def create_from_mmap(path, format, dimensions, stride = None, offset = 0, writable = False) :
+        "creates an Image whose pixels are mapped directly from the file with the" \
+        " specified path, which holds raw pixels in the specified Pixman format starting" \
+        " at the specified byte offset. dimensions is an integer Point specifying the" \
+        " dimensions of the image, and stride specifies how many bytes each row occupies" \
+        " in the file; if None, it defaults to format_stride(format, width). The OS" \
+        " page cache takes care of loading pixels as they are accessed.\n" \
+        "\n" \
+        "If writable, the file is mapped shared, so changes to the pixels are written" \
+        " back to the file. Otherwise, the file is mapped copy-on-write: it is never" \
+        " modified, and its pages are shared with other processes mapping the same file" \
+        " until the Image is drawn into."
+        width, height = Point.from_tuple(dimensions).assert_isint()
+        if width <= 0 or height <= 0 :
+            raise ValueError("dimensions must be positive")
+        #end if
+        if stride == None :
+            stride = format_stride(format, width)
+        #end if
+        if offset < 0 or offset % 4 != 0 :
+            raise ValueError("offset must be a non-negative multiple of 4")
+        #end if
+        length = height * stride
+        map_offset = offset - offset % mmap.ALLOCATIONGRANULARITY
+        with open(path, ("rb", "r+b")[writable]) as infile :
+            if os.fstat(infile.fileno()).st_size < offset + length :
+                raise ValueError("file “%s” too small to hold image" % path)
+            #end if
+            pixels = mmap.mmap \
+              (
+                infile.fileno(),
+                offset - map_offset + length,
+                access = (mmap.ACCESS_COPY, mmap.ACCESS_WRITE)[writable],
+                offset = map_offset
+              )
+              # mapping remains valid after file is closed
+        #end with
+        return \
+            Image.create_for_buffer(format, (width, height), memoryview(pixels)[offset - map_offset:], stride)
+    #end create_from_mmap
+
     @property
     def destroy_function(self) :
         "the destroy function and associated user data."
@@ -1776,25 +3296,39 @@ class Image :
     #end set_destroy_function
 
     def set_clip_region(self, region) :
-        if not isinstance(region, Region) :
-            raise TypeError("region must be a Region")
+        "sets a Region to clip drawing to, or removes any clip if region is None." \
+        " The Region is copied, so later changes to it have no effect."
+        if region != None :
+            if not isinstance(region, Region) :
+                raise TypeError("region must be a Region")
+            #end if
+            c_region = ct.byref(region._region)
+        else :
+            c_region = None
         #end if
-        if not pixman.pixman_image_set_clip_region32(self._pmobj, ct.byref(region._pmregion)) :
+        if not pixman.pixman_image_set_clip_region32(self._pmobj, c_region) :
             raise MemoryError("Pixman couldn’t set clip region")
         #end if
+        if region != None :
+            self._clip_region = Region.create()
+            region.copy(self._clip_region)
+        else :
+            self._clip_region = None
+        #end if
         return \
             self
     #end set_clip_region
 
     def set_has_client_clip(self, client_clip) :
         pixman.pixman_image_set_has_client_clip(self._pmobj, client_clip)
+        self._client_clip = bool(client_clip)
         return \
             self
     #end set_has_client_clip
 
     def set_transform(self, transform) :
         if transform != None :
-            c_transform = Transform.from_matrix(transform).to_pixman_fixed()
+            c_transform = Transform.from_matrix(transform).to_pixman_fixed(cached = True)
             c_transform_ref = ct.pointer(c_transform)
         else :
             c_transform_ref = None
@@ -1823,7 +3357,8 @@ class Image :
         elif not isinstance(filter, Filter) :
             raise TypeError("filter must be a Filter")
         #end if
-        if not pixman.pixman_image_set_filter(self._pmobj, filter._type, filter._values, filter._nr_values) :
+        c_values, nr_values = filter._to_pixman()
+        if not pixman.pixman_image_set_filter(self._pmobj, filter._type, c_values, nr_values) :
             raise RuntimeError("Pixman failed to set filter")
         #end if
         # Pixman copies the params array, so I don’t need to keep a reference
@@ -1833,6 +3368,7 @@ class Image :
 
     def set_source_clipping(self, source_clipping) :
         pixman.pixman_image_set_source_clipping(self._pmobj, source_clipping)
+        self._clip_sources = bool(source_clipping)
         return \
             self
     #end set_source_clipping
@@ -1845,6 +3381,8 @@ class Image :
         #end if
         origin = Point.from_tuple(origin).assert_isint()
         pixman.pixman_image_set_alpha_map(self._pmobj, alpha_map._pmobj, origin.x, origin.y)
+        self._alpha_map = alpha_map
+        self._alpha_origin = origin
         return \
             self
     #end set_alpha_map
@@ -1934,7 +3472,122 @@ class Image :
             self._set_accessors()
     #end set_accessors
 
-    # TODO: set_indexed
+    @staticmethod
+    def create_staged(format, dimensions, read_span = None, write_span = None) :
+        "creates a bits Image for pixels that live in some other storage which Pixman" \
+        " cannot address directly (e.g. byte-swapped or remote memory). Instead of" \
+        " per-pixel accessor callbacks, Pixman works on a local staging copy of the" \
+        " pixels at full speed, and whole spans are transferred to and from the real" \
+        " storage by load_spans and store_spans, or the staged context manager.\n" \
+        "\n" \
+        "read_span and write_span, if not None, are called as func(pos, width, buf)," \
+        " once per row, where pos is the integer Point of the first pixel of the span," \
+        " width is its number of pixels, and buf is a memoryview of the corresponding" \
+        " bytes of the staging copy. read_span must fill in buf from the real storage;" \
+        " write_span must copy buf (which is read-only) back to it. For formats with" \
+        " less than 8 bits per pixel, buf is widened to whole bytes."
+        result = Image.create_bits(format, dimensions, clear = read_span == None)
+        result._read_span = read_span
+        result._write_span = write_span
+        return \
+            result
+    #end create_staged
+
+    def _spans(self, rect, readonly) :
+        # generates (pos, width, buf) for each row of rect, clipped to the Image
+        # bounds, with buf a memoryview of the corresponding staging bytes.
+        bounds = Rect.from_dimensions(self.dimensions)
+        if rect != None :
+            rect = Rect.from_rect(rect).assert_isint().intersection(bounds)
+        else :
+            rect = bounds
+        #end if
+        if rect.width > 0 and rect.height > 0 :
+            bpp = PIXMAN.FORMAT_BPP(self.format)
+            stride = self.stride
+            if stride < 0 :
+                raise ValueError("cannot stage Image with negative stride")
+            #end if
+            c_pixels = (ct.c_ubyte * (self.height * stride)).from_address(self.data)
+            c_pixels._pixman_image = self # ensure pixels don’t go away prematurely
+            pixels = memoryview(c_pixels).cast("B")
+            if readonly :
+                pixels = pixels.toreadonly()
+            #end if
+            start = rect.left * bpp // 8
+            end = ((rect.left + rect.width) * bpp + 7) // 8
+            for y in range(rect.top, rect.top + rect.height) :
+                offset = y * stride
+                yield Point(rect.left, y), rect.width, pixels[offset + start : offset + end]
+            #end for
+        #end if
+    #end _spans
+
+    def load_spans(self, rect = None) :
+        "fills in the staging copy of a staged Image from the real storage, by calling" \
+        " read_span for each row of the specified Rect, or of the whole Image if None."
+        if self._read_span == None :
+            raise ValueError("Image has no read_span function")
+        #end if
+        read_span = self._read_span
+        for pos, width, buf in self._spans(rect, False) :
+            read_span(pos, width, buf)
+        #end for
+        return \
+            self
+    #end load_spans
+
+    def store_spans(self, rect = None) :
+        "copies the staging copy of a staged Image back to the real storage, by calling" \
+        " write_span for each row of the specified Rect, or of the whole Image if None."
+        if self._write_span == None :
+            raise ValueError("Image has no write_span function")
+        #end if
+        write_span = self._write_span
+        for pos, width, buf in self._spans(rect, True) :
+            write_span(pos, width, buf)
+        #end for
+        return \
+            self
+    #end store_spans
+
+    @contextlib.contextmanager
+    def staged(self, rect = None) :
+        "context manager for working on a staged Image: loads the specified Rect (or" \
+        " the whole Image if None) on entry, if there is a read_span function, and" \
+        " stores it back on normal exit, if there is a write_span function."
+        if self._read_span != None :
+            self.load_spans(rect)
+        #end if
+        yield self
+        if self._write_span != None :
+            self.store_spans(rect)
+        #end if
+    #end staged
+
+    @property
+    def palette(self) :
+        "the Palette for an indexed-format Image."
+        return \
+            self._palette
+    #end palette
+
+    @palette.setter
+    def palette(self, palette) :
+        self.set_indexed(palette)
+    #end palette
+
+    def set_indexed(self, palette) :
+        "sets the Palette for an indexed-format Image. Useful for method chaining;" \
+        " otherwise just assign to the palette property."
+        if not isinstance(palette, Palette) :
+            raise TypeError("palette must be a Palette")
+        #end if
+        pixman.pixman_image_set_indexed(self._pmobj, ct.byref(palette._indexed))
+        self._palette = palette # Pixman keeps a pointer to the table
+        return \
+            self
+    #end set_indexed
 
     @property
     def data(self) :
@@ -1985,6 +3638,230 @@ class Image :
             pixman.pixman_image_get_format(self._pmobj)
     #end format
 
+    def _pixel_layout(self) :
+        # returns the element size in bytes, and the shape and strides in bytes,
+        # for exposing the pixels of a bits image as an array.
+        if self.data == None :
+            raise ValueError("not a bits Image")
+        #end if
+        bpp = PIXMAN.FORMAT_BPP(self.format)
+        width, height, stride = self.width, self.height, self.stride
+        if bpp in (8, 16, 32) :
+            itemsize = bpp // 8
+            shape = (height, width)
+            strides = (stride, itemsize)
+        elif bpp == 24 :
+            itemsize = 1
+            shape = (height, width, 3)
+            strides = (stride, 3, 1)
+        else :
+            raise ValueError("pixels of %d bits cannot be addressed as array elements" % bpp)
+        #end if
+        return \
+            itemsize, shape, strides
+    #end _pixel_layout
+
+    @property
+    def __array_interface__(self) :
+        "describes the pixels of a bits Image according to the NumPy array interface," \
+        " so numpy.asarray(image) can wrap them without copying. Formats with 8, 16" \
+        " or 32 bits per pixel give a two-dimensional (height, width) array of unsigned" \
+        " integers holding entire pixel values in native byte order; 24-bit formats give" \
+        " a (height, width, 3) array of bytes. For other images and formats, the" \
+        " attribute is absent (raises AttributeError), so that array-probing code such" \
+        " as hasattr and NumPy itself treats the Image as an ordinary object."
+        try :
+            itemsize, shape, strides = self._pixel_layout()
+        except ValueError as fail :
+            raise AttributeError(str(fail))
+        #end try
+        return \
+            {
+                "version" : 3,
+                "shape" : shape,
+                "typestr" :
+                        ("|", {"little" : "<", "big" : ">"}[sys.byteorder])[itemsize > 1]
+                    +
+                        "u%d" % itemsize,
+                "data" : (self.data, False),
+                "strides" : strides,
+            }
+    #end __array_interface__
+
+    def as_ndarray(self) :
+        "returns a NumPy array that accesses the pixels of this bits Image without" \
+        " copying, as described for __array_interface__. The array keeps a reference" \
+        " to the Image, so the pixels remain valid for as long as the array exists." \
+        " Requires NumPy to be installed."
+        import numpy
+        self._pixel_layout() # raise ValueError for unsupported images
+        return \
+            numpy.asarray(self)
+    #end as_ndarray
+
+    def as_memoryview(self) :
+        "returns a memoryview that accesses the pixels of this bits Image without" \
+        " copying. The element types are as described for __array_interface__, except" \
+        " that each row includes any padding up to the stride, so the shape is" \
+        " (height, stride // element size). The memoryview keeps a reference to the" \
+        " Image, so the pixels remain valid for as long as the memoryview exists."
+        itemsize, shape, strides = self._pixel_layout()
+        height, stride = shape[0], strides[0]
+        if stride < 0 :
+            raise ValueError("cannot export Image with negative stride")
+        #end if
+        c_pixels = (ct.c_ubyte * (height * stride)).from_address(self.data)
+        c_pixels._pixman_image = self # ensure pixels don’t go away prematurely
+        result = memoryview(c_pixels).cast("B")
+        if height != 0 :
+            result = result.cast({1 : "B", 2 : "H", 4 : "I"}[itemsize], (height, stride // itemsize))
+        #end if
+        return \
+            result
+    #end as_memoryview
+
+    def blur(self, radius, quality = 3, dest = None, roi = None) :
+        "applies an approximately-Gaussian blur to this bits Image, by a cascade of" \
+        " quality box filters whose radii add up to radius, which may be a single" \
+        " integer or an integer Point giving separate horizontal and vertical radii." \
+        " Each box pass is computed from exact integer running sums, so the cost does" \
+        " not depend on the radius, and its result is rounded to 8 bits before the next" \
+        " pass. Pixels outside the Image are treated as transparent.\n" \
+        "\n" \
+        "The result goes into dest, which must be a bits Image of the same format," \
+        " or this Image itself if dest is None. If roi is not None, it is a Rect giving" \
+        " the only area of dest to be updated; it is clipped to the bounds of both" \
+        " Images, and only the pixels of this Image within radius of it are read." \
+        " Supports a8 and 32-bit formats with 8-bit channels. Requires NumPy to be" \
+        " installed. Returns dest."
+        import numpy
+        if isinstance(radius, Real) :
+            radius = Point(radius, radius)
+        #end if
+        radius = Point.from_tuple(radius).assert_isint()
+        if radius.x < 0 or radius.y < 0 :
+            raise ValueError("radius must not be negative")
+        #end if
+        if not isinstance(quality, int) or quality < 1 :
+            raise ValueError("quality must be a positive integer")
+        #end if
+        if dest == None :
+            dest = self
+        elif not isinstance(dest, Image) :
+            raise TypeError("dest must be an Image")
+        #end if
+        fmt = self.format
+        if dest.format != fmt :
+            raise ValueError("dest must have same format as source")
+        #end if
+        if fmt == PIXMAN.a8 :
+            nr_channels = 1
+        elif (
+                PIXMAN.FORMAT_BPP(fmt) == 32
+            and
+                PIXMAN.FORMAT_TYPE(fmt) in (PIXMAN.TYPE_ARGB, PIXMAN.TYPE_ABGR, PIXMAN.TYPE_BGRA, PIXMAN.TYPE_RGBA)
+            and
+                all
+                  (
+                    bits in (0, 8)
+                    for bits in
+                        (PIXMAN.FORMAT_A(fmt), PIXMAN.FORMAT_R(fmt), PIXMAN.FORMAT_G(fmt), PIXMAN.FORMAT_B(fmt))
+                  )
+        ) :
+            nr_channels = 4
+        else :
+            raise ValueError("unsupported pixel format for blur")
+        #end if
+        bounds = Rect.from_dimensions(self.dimensions)
+        dest_bounds = Rect.from_dimensions(dest.dimensions)
+        if roi != None :
+            roi = Rect.from_rect(roi).assert_isint()
+        else :
+            roi = dest_bounds
+        #end if
+        roi = roi.intersection(bounds).intersection(dest_bounds)
+        chunk_elements = 1 << 20 # prefix sums to compute at once, to limit memory usage
+
+        def channels(image, area) :
+            # returns a writable (height, width, nr_channels) array of bytes giving
+            # direct access to the specified area of the pixels of image.
+            pixels = image.as_ndarray()[area.top : area.bottom, area.left : area.right]
+            return \
+                numpy.lib.stride_tricks.as_strided \
+                  (
+                    pixels.view(numpy.uint8),
+                    shape = (area.height, area.width, nr_channels),
+                    strides = (pixels.strides[0], nr_channels, 1),
+                    writeable = True
+                  )
+        #end channels
+
+        def box_pass(pixels, r, axis) :
+            # returns a new array of bytes holding the running mean, rounded to the
+            # nearest integer, of the bytes in pixels over a window of width 2 * r + 1
+            # along the specified axis, treating pixels beyond the array as zero.
+            # The window sums are differences of exact integer prefix sums, computed
+            # a chunk at a time across the other axis to limit the temporary storage.
+            pixels = numpy.swapaxes(pixels, 0, axis)
+            n = pixels.shape[0]
+            width = 2 * r + 1
+            if 255 * n < 1 << 32 :
+                sum_type = numpy.uint32
+            else :
+                sum_type = numpy.uint64
+            #end if
+            result = numpy.empty(pixels.shape, dtype = numpy.uint8)
+            inner = int(numpy.prod(pixels.shape[2:]))
+            step = max(chunk_elements // ((n + width) * inner), 1)
+            for start in range(0, pixels.shape[1], step) :
+                chunk = pixels[:, start : start + step]
+                # sums[k] is the total of the first k pixels of the chunk padded
+                # with r + 1 zeros at the start and r at the end.
+                sums = numpy.zeros((n + width,) + chunk.shape[1:], dtype = sum_type)
+                numpy.cumsum(chunk, axis = 0, dtype = sum_type, out = sums[r + 1 : r + 1 + n])
+                sums[r + 1 + n:] = sums[r + n]
+                window = sums[width : width + n] - sums[:n]
+                window += width // 2
+                window //= width
+                result[:, start : start + step] = window
+            #end for
+            return \
+                numpy.swapaxes(result, 0, axis)
+        #end box_pass
+
+        def pass_radii(r) :
+            # divides r as evenly as possible among the passes.
+            return \
+                list(r // quality + (i < r % quality) for i in range(quality))
+        #end pass_radii
+
+    #begin blur
+        if roi.width > 0 and roi.height > 0 :
+            # each pass can only move information by its own radius, so the pixels
+            # read need extend no further than the total radius beyond roi.
+            src_area = Rect.from_corners \
+              (
+                roi.topleft - radius,
+                roi.topleft + roi.dimensions + radius
+              ).intersection(bounds)
+            pixels = channels(self, src_area)
+              # first pass reads directly from the Image and makes a new array
+            for rx, ry in zip(pass_radii(radius.x), pass_radii(radius.y)) :
+                if rx != 0 :
+                    pixels = box_pass(pixels, rx, 1)
+                #end if
+                if ry != 0 :
+                    pixels = box_pass(pixels, ry, 0)
+                #end if
+            #end for
+            offset = roi.topleft - src_area.topleft
+            result = pixels[offset.y : offset.y + roi.height, offset.x : offset.x + roi.width]
+            channels(dest, roi)[...] = result
+        #end if
+        return \
+            dest
+    #end blur
+
     def fill_rectangles(self, op, colour, rects) :
         "fills the specified sequence of rectangles using the given colour and operator."
         # actually calls pixman_image_fill_boxes. I can’t be bothered with
@@ -2002,7 +3879,69 @@ class Image :
             self
     #end fill_rectangles
 
-    # TODO: trapezoids
+    def rasterize_trapezoids(self, trapezoids, offset = (0, 0)) :
+        "rasterizes each of the Trapezoids into this Image, which would normally" \
+        " be an alpha-only format like PIXMAN.a8, adding to its existing coverage." \
+        " offset is an integer Point giving a displacement to apply to all the" \
+        " trapezoids."
+        if not isinstance(trapezoids, Trapezoids) :
+            raise TypeError("trapezoids must be a Trapezoids object")
+        #end if
+        offset = Point.from_tuple(offset).assert_isint()
+        address, nr_traps = trapezoids._to_pixman()
+        trap_size = ct.sizeof(PIXMAN.trapezoid_t)
+        for i in range(nr_traps) :
+            pixman.pixman_rasterize_trapezoid(self._pmobj, address + i * trap_size, offset.x, offset.y)
+        #end for
+        return \
+            self
+    #end rasterize_trapezoids
+
+    def add_trapezoids(self, trapezoids, offset = (0, 0)) :
+        "adds the antialiased coverage of the Trapezoids to this Image, which would" \
+        " normally be an alpha-only format like PIXMAN.a8. offset is an integer Point" \
+        " giving a displacement to apply to all the trapezoids; Pixman limits offset.x" \
+        " to 16 bits."
+        if not isinstance(trapezoids, Trapezoids) :
+            raise TypeError("trapezoids must be a Trapezoids object")
+        #end if
+        offset = Point.from_tuple(offset).assert_isint()
+        if not qah.int_fits_bits(offset.x, 16) :
+            raise ValueError("offset.x must be a signed 16-bit integer")
+        #end if
+        address, nr_traps = trapezoids._to_pixman()
+        pixman.pixman_add_trapezoids(self._pmobj, offset.x, offset.y, nr_traps, address)
+        return \
+            self
+    #end add_trapezoids
+
+    def add_traps(self, traps, offset = (0, 0)) :
+        "adds the antialiased coverage of the Traps to this Image, which would" \
+        " normally be an alpha-only format like PIXMAN.a8. offset is a Point of signed" \
+        " 16-bit integers giving a displacement to apply to all the traps."
+        if not isinstance(traps, Traps) :
+            raise TypeError("traps must be a Traps object")
+        #end if
+        offset = Point.from_tuple(offset).assert_isshortint()
+        address, nr_traps = traps._to_pixman()
+        pixman.pixman_add_traps(self._pmobj, offset.x, offset.y, nr_traps, address)
+        return \
+            self
+    #end add_traps
+
+    def add_triangles(self, triangles, offset = (0, 0)) :
+        "adds the antialiased coverage of the Triangles to this Image, which would" \
+        " normally be an alpha-only format like PIXMAN.a8. offset is an integer Point" \
+        " giving a displacement to apply to all the triangles."
+        if not isinstance(triangles, Triangles) :
+            raise TypeError("triangles must be a Triangles object")
+        #end if
+        offset = Point.from_tuple(offset).assert_isint()
+        address, nr_tris = triangles._to_pixman()
+        pixman.pixman_add_triangles(self._pmobj, offset.x, offset.y, nr_tris, address)
+        return \
+            self
+    #end add_triangles
 
     def create_like(self) :
         "creates a bits Image with the same format and dimensions as this one."
@@ -2010,6 +3949,27 @@ class Image :
             Image.create_bits(format = self.format, dimensions = self.dimensions)
     #end create_like
 
+    def _reset_state(self) :
+        # restores the default settings for everything other than the pixels,
+        # for reuse by an ImagePool.
+        self.set_transform(None)
+        self.set_filter(None)
+        self.set_repeat(PIXMAN.REPEAT_NONE)
+        self.set_clip_region(None)
+        self.set_has_client_clip(False)
+        self.set_source_clipping(False)
+        self.set_component_alpha(False)
+        if self._alpha_map != None :
+            pixman.pixman_image_set_alpha_map(self._pmobj, None, 0, 0)
+            self._alpha_map = None
+            self._alpha_origin = None
+        #end if
+        if self._palette != None :
+            pixman.pixman_image_set_indexed(self._pmobj, None)
+            self._palette = None
+        #end if
+    #end _reset_state
+
     def create_cairo_surface(self) :
         "creates a Cairo ImageSurface that accesses the pixels of this Image." \
         " Only valid for a bits image."
@@ -2051,12 +4011,19 @@ class Image :
 #end Image
 
 def compute_composite_region(region, src, mask, dest, src_pos, mask_pos, dest_pos, dimensions) :
-    # Note that Pixman does not (currently) provide a region32 version of this call.
-    # Since I don’t want to add full region16 support just for this one call, I create
-    # a temporary region16 and convert the result to the caller’s region32 afterwards.
-    # Just to add insult to injury, the Pixman source code makes use of an internal
-    # _pixman_compute_composite_region32 routine to do the work, then converts the
-    # result to a region16 before returning it to us.
+    "computes the area of dest that would actually be affected by the corresponding" \
+    " image_composite call, putting it into the Region region, and returns whether it" \
+    " is nonempty; if not, the composite can be skipped.\n" \
+    "\n" \
+    "Pixman only provides a 16-bit-region version of this call, so this reimplements" \
+    " the same logic with 32-bit Region operations: the destination rectangle is" \
+    " clipped to the bounds and clip region of dest and of its alpha map, if any, then" \
+    " to the clip regions of src and mask, and of their alpha maps, where these have" \
+    " both source clipping and client clip enabled. Clip settings are those made" \
+    " through the Image methods, since Pixman provides no way to query them."
+    if not isinstance(region, Region) :
+        raise TypeError("region must be a Region")
+    #end if
     if (
             not isinstance(src, Image)
         or
@@ -2066,31 +4033,76 @@ def compute_composite_region(region, src, mask, dest, src_pos, mask_pos, dest_po
     ) :
         raise TypeError("image args must be Image objects")
     #end if
-    tmp_region = PIXMAN.region16_t()
-    src_pos = Point.from_tuple(src_pos).assert_isshortint()
+    src_pos = Point.from_tuple(src_pos).assert_isint()
     if mask != None or mask_pos != None :
         # “or”, not “and”: mask_pos must be specified if mask is specified
-        mask_pos = Point.from_tuple(mask_pos).assert_isshortint()
-    else :
-        mask_pos = Point(0, 0) # dummy
+        mask_pos = Point.from_tuple(mask_pos).assert_isint()
     #end if
-    dest_pos = Point.from_tuple(dest_pos).assert_isshortint()
-    dimensions = Point.from_tuple(dimensions).assert_isshortint()
-    pixman.pixman_region_init(ct.byref(tmp_region))
-    if mask != None :
-        c_mask = mask._pmobj
+    dest_pos = Point.from_tuple(dest_pos).assert_isint()
+    dimensions = Point.from_tuple(dimensions).assert_isint()
+
+    def clip_general(clip, offset) :
+        # intersects region with clip, positioned at offset in dest coordinates.
+        if offset != Point(0, 0) :
+            moved = Region.create()
+            clip.copy(moved)
+            clip = moved.translate(offset)
+        #end if
+        region.intersect(clip, region)
+        return \
+            region.not_empty
+    #end clip_general
+
+    def clip_source(image, offset) :
+        # source clips are ignored unless both explicitly enabled and set by a client.
+        if image._clip_region != None and image._clip_sources and image._client_clip :
+            result = clip_general(image._clip_region, offset)
+        else :
+            result = True
+        #end if
+        return \
+            result
+    #end clip_source
+
+#begin compute_composite_region
+    dest_rect = Rect.from_corners \
+      (
+        (max(dest_pos.x, 0), max(dest_pos.y, 0)),
+        (min(dest_pos.x + dimensions.x, dest.width), min(dest_pos.y + dimensions.y, dest.height))
+      )
+    if dest_rect.width > 0 and dest_rect.height > 0 :
+        region.reset(dest_rect)
+        result = True
     else :
-        c_mask = None
+        region.clear()
+        result = False
+    #end if
+    if result and dest._clip_region != None :
+        result = clip_general(dest._clip_region, Point(0, 0))
+    #end if
+    if result and dest._alpha_map != None :
+        alpha_map, origin = dest._alpha_map, dest._alpha_origin
+        region.intersect_rect(Rect.from_corners(origin, origin + alpha_map.dimensions), region)
+        result = region.not_empty
+        if result and alpha_map._clip_region != None :
+            result = clip_general(alpha_map._clip_region, - origin)
+        #end if
     #end if
-    pixman.pixman_compute_composite_region(ct.byref(tmp_region), src._pmobj, c_mask, dest._pmobj, src_pos.x, src_pos.y, mask_pos.x, mask_pos.y, dest_pos.x, dest_pos.y, dimensions.x, dimensions.y)
-      # returns false on empty region or allocation failure. Since I cannot distinguish
-      # these two cases, I ignore the result.
-    nr_rects = ct.c_int()
-    rects16 = pixman.pixman_region_rectangles(ct.byref(self._region), ct.byref(nr_rects))
-    nr_rects = nr_rects.value
-    rects16 = ct.cast(rects16, PIXMAN.box16_t_ptr)
-    Region.create_rects(list(Rect.from_pixman_box(rects16[i]) for i in range(nr_rects))).copy(region)
-    pixman.pixman_region_fini(ct.byref(tmp_region))
+    for image, pos in ((src, src_pos), (mask, mask_pos)) :
+        if not result or image == None :
+            break
+        #end if
+        offset = dest_pos - pos
+        result = clip_source(image, offset)
+        if result and image._alpha_map != None :
+            result = clip_source(image._alpha_map, offset + image._alpha_origin)
+        #end if
+    #end for
+    if not result :
+        region.clear()
+    #end if
+    return \
+        result
 #end compute_composite_region
 
 def image_composite(op, src, mask, dest, src_pos, mask_pos, dest_pos, dimensions) :
@@ -2126,4 +4138,1525 @@ def image_composite(op, src, mask, dest, src_pos, mask_pos, dest_pos, dimensions
     pixman.pixman_image_composite32(op, src._pmobj, c_mask, dest._pmobj, src_pos.x, src_pos.y, mask_pos.x, mask_pos.y, dest_pos.x, dest_pos.y, dimensions.x, dimensions.y)
 #end image_composite
 
-# TODO: glyphs
+_shared_executor = None
+_shared_executor_lock = threading.Lock()
+
+def shared_executor() :
+    "returns the thread pool shared by the parallel compositing routines, creating" \
+    " it on first use with one worker thread per CPU."
+    global _shared_executor
+    with _shared_executor_lock :
+        if _shared_executor == None :
+            _shared_executor = concurrent.futures.ThreadPoolExecutor \
+              (
+                max_workers = os.cpu_count() or 1,
+                thread_name_prefix = "pixman"
+              )
+        #end if
+    #end with
+    return \
+        _shared_executor
+#end shared_executor
+
+def _run_bands(executor, do_band, bands) :
+    # runs do_band(band) for each of the bands on the executor, waiting for all
+    # to finish and propagating any exception.
+    if executor == None :
+        executor = shared_executor()
+    #end if
+    for future in list(executor.submit(do_band, band) for band in bands) :
+        future.result()
+    #end for
+#end _run_bands
+
+def split_bands(top, height, nr_bands, min_band_height = 1) :
+    "divides height rows starting at top into up to nr_bands horizontal bands of" \
+    " nearly equal height, each at least min_band_height rows (apart from when height" \
+    " itself is smaller). Returns a list of (top, height) tuples."
+    nr_bands = max(min(nr_bands, height // max(min_band_height, 1)), 1)
+    return \
+        list \
+          (
+            (top + height * i // nr_bands, height * (i + 1) // nr_bands - height * i // nr_bands)
+            for i in range(nr_bands)
+          )
+#end split_bands
+
+def image_composite_parallel(op, src, mask, dest, src_pos, mask_pos, dest_pos, dimensions, threads = None, executor = None, min_band_height = 16) :
+    "does the same thing as image_composite, but splits the destination rectangle into" \
+    " horizontal bands which are composited concurrently on a thread pool (ctypes" \
+    " releases the GIL around the Pixman calls). threads is the number of bands to" \
+    " split into, defaulting to the number of CPUs; executor is the" \
+    " concurrent.futures.Executor to use, defaulting to shared_executor(); and no" \
+    " band will be less than min_band_height rows. Source and mask positions are" \
+    " offset by the same amount as each band, so sources and masks with transforms" \
+    " and filters give the same result as a single image_composite call. dest must" \
+    " not also be used as src or mask."
+    if (
+            not isinstance(src, Image)
+        or
+            mask != None and not isinstance(mask, Image)
+        or
+            not isinstance(dest, Image)
+    ) :
+        raise TypeError("image args must be Image objects")
+    #end if
+    src_pos = Point.from_tuple(src_pos).assert_isint()
+    if mask != None or mask_pos != None :
+        mask_pos = Point.from_tuple(mask_pos).assert_isint()
+    else :
+        mask_pos = Point(0, 0) # dummy
+    #end if
+    dest_pos = Point.from_tuple(dest_pos).assert_isint()
+    dimensions = Point.from_tuple(dimensions).assert_isint()
+    if mask != None :
+        c_mask = mask._pmobj
+    else :
+        c_mask = None
+    #end if
+    if threads == None :
+        threads = os.cpu_count() or 1
+    #end if
+    composite = pixman.pixman_image_composite32
+
+    def do_band(band) :
+        top, height = band
+        dy = top - dest_pos.y
+        composite(op, src._pmobj, c_mask, dest._pmobj, src_pos.x, src_pos.y + dy, mask_pos.x, mask_pos.y + dy, dest_pos.x, top, dimensions.x, height)
+    #end do_band
+
+#begin image_composite_parallel
+    bands = split_bands(dest_pos.y, dimensions.y, threads, min_band_height)
+    if len(bands) > 1 :
+        # Pixman lazily recomputes cached state in each image the first time it is
+        # used after a change; do that on this thread with a zero-size composite,
+        # so the bands do not race to update it.
+        composite(op, src._pmobj, c_mask, dest._pmobj, src_pos.x, src_pos.y, mask_pos.x, mask_pos.y, dest_pos.x, dest_pos.y, 0, 0)
+        _run_bands(executor, do_band, bands)
+    else :
+        do_band(bands[0])
+    #end if
+#end image_composite_parallel
+
+def _copy_source_settings(src, proxy, first) :
+    # copies the settings of src that affect how its pixels are read, namely
+    # any palette and alpha map, onto proxy, which holds rows of src starting
+    # at row first.
+    if src._palette != None :
+        proxy.set_indexed(src._palette)
+    #end if
+    if src._alpha_map != None :
+        proxy.set_alpha_map(src._alpha_map, src._alpha_origin - Point(0, first))
+    #end if
+#end _copy_source_settings
+
+def _copy_rows(src, first, last) :
+    # returns a new bits Image holding a copy of rows [first, last) of bits Image src,
+    # with the same width, format and stride, made without going through Pixman.
+    # The palette and alpha map, if any, are carried over.
+    stride = src.stride
+    nr_bytes = (last - first) * stride
+    pixels = bytearray(nr_bytes)
+    if nr_bytes != 0 :
+        ct.memmove((ct.c_ubyte * nr_bytes).from_buffer(pixels), src.data + first * stride, nr_bytes)
+    #end if
+    result = Image.create_for_buffer(src.format, (src.width, last - first), pixels, stride)
+    _copy_source_settings(src, result, first)
+    return \
+        result
+#end _copy_rows
+
+def image_filter_parallel(filter, src, dest, src_pos = (0, 0), dest_pos = (0, 0), dimensions = None, op = PIXMAN.OP_SRC, repeat = PIXMAN.REPEAT_NONE, threads = None, executor = None, min_band_height = 16) :
+    "applies the Filter, with the specified PIXMAN.REPEAT_xxx setting and no transform," \
+    " to the portion of bits Image src with the top left at src_pos and the specified" \
+    " dimensions (defaulting to the whole of src), and composites the result onto dest" \
+    " at dest_pos according to operator op. The work is split into horizontal bands" \
+    " which run concurrently on a thread pool, as for image_composite_parallel, and" \
+    " the result is bit-identical to doing the same composite serially. The filter" \
+    " and repeat settings of src itself are left untouched; its palette and alpha map," \
+    " if any, are honoured.\n" \
+    "\n" \
+    "dest may be the same as src. In that case, each band first takes a private copy" \
+    " of its source rows plus a halo of extra rows above and below, sized from" \
+    " filter.halo, before any band writes its output, so that bands never see each" \
+    " other’s results. (With REPEAT_NORMAL or REPEAT_REFLECT, pixels could wrap" \
+    " around from the opposite edge, so a copy of all of src is taken instead.)"
+    if not isinstance(filter, Filter) :
+        raise TypeError("filter must be a Filter")
+    #end if
+    if not isinstance(src, Image) or not isinstance(dest, Image) :
+        raise TypeError("image args must be Image objects")
+    #end if
+    if src.data == None :
+        raise ValueError("src is not a bits Image")
+    #end if
+    src_pos = Point.from_tuple(src_pos).assert_isint()
+    dest_pos = Point.from_tuple(dest_pos).assert_isint()
+    if dimensions == None :
+        dimensions = src.dimensions
+    #end if
+    dimensions = Point.from_tuple(dimensions).assert_isint()
+    if threads == None :
+        threads = os.cpu_count() or 1
+    #end if
+    src_format, src_dimensions, src_stride = src.format, src.dimensions, src.stride
+    in_place = dest is src or dest.data == src.data
+    if not in_place or repeat in (PIXMAN.REPEAT_NORMAL, PIXMAN.REPEAT_REFLECT) :
+        if in_place :
+            source = _copy_rows(src, 0, src_dimensions.y)
+        else :
+            # separate Image sharing the same pixels, so I can set filter and repeat
+            # without disturbing the settings on src
+            source = Image.create_bits(src_format, src_dimensions, src.data, src_stride)
+            source._arr = src # to ensure pixels don’t go away prematurely
+            _copy_source_settings(src, source, 0)
+        #end if
+        source.set_filter(filter).set_repeat(repeat)
+        image_composite_parallel \
+          (
+            op = op,
+            src = source,
+            mask = None,
+            dest = dest,
+            src_pos = src_pos,
+            mask_pos = None,
+            dest_pos = dest_pos,
+            dimensions = dimensions,
+            threads = threads,
+            executor = executor,
+            min_band_height = min_band_height
+          )
+    else :
+        halo = filter.halo
+        bands = split_bands(dest_pos.y, dimensions.y, threads, min_band_height)
+        sources = [None] * len(bands)
+
+        def copy_band(i) :
+            # takes a private copy of the source rows needed for band i, which
+            # always extends across the full width of src, so only the top and
+            # bottom edges of the copy can differ from those of src.
+            top, height = bands[i]
+            src_top = src_pos.y + top - dest_pos.y
+            first = min(max(src_top - halo.y, 0), src_dimensions.y)
+            last = max(min(src_top + height + halo.y, src_dimensions.y), first)
+            source = _copy_rows(src, first, last)
+            source.set_filter(filter).set_repeat(repeat)
+            sources[i] = (source, first)
+        #end copy_band
+
+        def filter_band(i) :
+            top, height = bands[i]
+            source, first = sources[i]
+            pixman.pixman_image_composite32 \
+              (
+                op,
+                source._pmobj,
+                None,
+                dest._pmobj,
+                src_pos.x,
+                src_pos.y + top - dest_pos.y - first,
+                0,
+                0,
+                dest_pos.x,
+                top,
+                dimensions.x,
+                height
+              )
+        #end filter_band
+
+        nr_bands = len(bands)
+        if nr_bands > 1 :
+            _run_bands(executor, copy_band, range(nr_bands))
+            # validate dest on this thread, as in image_composite_parallel
+            pixman.pixman_image_composite32(op, sources[0][0]._pmobj, None, dest._pmobj, 0, 0, 0, 0, dest_pos.x, dest_pos.y, 0, 0)
+            _run_bands(executor, filter_band, range(nr_bands))
+        else :
+            copy_band(0)
+            filter_band(0)
+        #end if
+    #end if
+#end image_filter_parallel
+
+COMPOSITE_RECORD_LEN = 12
+  # number of integers in each packed record for image_composite_many
+
+def image_composite_many(ops, images = None) :
+    "does a whole batch of image_composite calls, validating all the arguments" \
+    " up front and then calling Pixman in a tight loop. If images is None, then ops" \
+    " is a sequence of (op, src, mask, dest, src_pos, mask_pos, dest_pos, dimensions)" \
+    " tuples, with the same meanings as the arguments to image_composite.\n" \
+    "\n" \
+    "Otherwise, images is a sequence of Image objects, and ops is a packed array of" \
+    " signed 32-bit integers (e.g. array.array(\"i\"), or any other object exporting" \
+    " a buffer of integers, which will be converted if they are not 32-bit) made up of" \
+    " records of COMPOSITE_RECORD_LEN integers each:" \
+    " op, src_index, mask_index, dest_index, src_x, src_y, mask_x, mask_y, dest_x," \
+    " dest_y, width, height. The indexes select entries from images, with a mask_index" \
+    " of -1 meaning no mask. This saves constructing Python objects for every record."
+
+    checked = {}
+
+    def check_image(image, optional) :
+        # returns the Pixman image pointer, checking each distinct object only once.
+        if image == None :
+            if not optional :
+                raise TypeError("image args must be Image objects")
+            #end if
+            result = None
+        else :
+            key = id(image)
+            if key not in checked :
+                if not isinstance(image, Image) :
+                    raise TypeError("image args must be Image objects")
+                #end if
+                checked[key] = (image, image._pmobj)
+                  # keeping a reference to image ensures its id won’t be reused
+            #end if
+            result = checked[key][1]
+        #end if
+        return \
+            result
+    #end check_image
+
+    def check_pos(pos) :
+        x, y = pos
+        if not qah.int_fits_bits(x, 32) or not qah.int_fits_bits(y, 32) :
+            raise ValueError("components must be signed 32-bit integers")
+        #end if
+        return \
+            (x, y)
+    #end check_pos
+
+#begin image_composite_many
+    batch = []
+    if images == None :
+        for op, src, mask, dest, src_pos, mask_pos, dest_pos, dimensions in ops :
+            c_src = check_image(src, False)
+            c_mask = check_image(mask, True)
+            c_dest = check_image(dest, False)
+            src_x, src_y = check_pos(src_pos)
+            if mask != None or mask_pos != None :
+                mask_x, mask_y = check_pos(mask_pos)
+            else :
+                mask_x, mask_y = 0, 0 # dummy
+            #end if
+            dest_x, dest_y = check_pos(dest_pos)
+            width, height = check_pos(dimensions)
+            batch.append \
+              (
+                (op, c_src, c_mask, c_dest, src_x, src_y, mask_x, mask_y, dest_x, dest_y, width, height)
+              )
+        #end for
+    else :
+        c_images = list(check_image(image, False) for image in images)
+        nr_images = len(c_images)
+        c_ops = _int32_view(ops).tolist()
+        if len(c_ops) % COMPOSITE_RECORD_LEN != 0 :
+            raise ValueError("ops length must be a multiple of %d" % COMPOSITE_RECORD_LEN)
+        #end if
+        for i in range(0, len(c_ops), COMPOSITE_RECORD_LEN) :
+            rec = c_ops[i : i + COMPOSITE_RECORD_LEN]
+            src_index, mask_index, dest_index = rec[1:4]
+            if (
+                    not 0 <= src_index < nr_images
+                or
+                    not -1 <= mask_index < nr_images
+                or
+                    not 0 <= dest_index < nr_images
+            ) :
+                raise IndexError("image index out of range in record %d" % (i // COMPOSITE_RECORD_LEN))
+            #end if
+            rec[1] = c_images[src_index]
+            rec[2] = (None, c_images[mask_index])[mask_index >= 0]
+            rec[3] = c_images[dest_index]
+            batch.append(rec)
+        #end for
+    #end if
+    composite = pixman.pixman_image_composite32
+    for rec in batch :
+        composite(*rec)
+    #end for
+#end image_composite_many
+
+def composite_trapezoids(op, src, dest, mask_format, src_pos, dest_pos, trapezoids) :
+    "rasterizes the Trapezoids into a temporary mask with the specified format (e.g." \
+    " PIXMAN.a8), and composites Image src through it onto Image dest according to" \
+    " operator op (a PIXMAN.OP_xxx value). The trapezoid coordinates are relative to" \
+    " dest_pos in dest, and relative to src_pos in src."
+    if not isinstance(src, Image) or not isinstance(dest, Image) :
+        raise TypeError("image args must be Image objects")
+    #end if
+    if not isinstance(trapezoids, Trapezoids) :
+        raise TypeError("trapezoids must be a Trapezoids object")
+    #end if
+    src_pos = Point.from_tuple(src_pos).assert_isint()
+    dest_pos = Point.from_tuple(dest_pos).assert_isint()
+    address, nr_traps = trapezoids._to_pixman()
+    pixman.pixman_composite_trapezoids(op, src._pmobj, dest._pmobj, mask_format, src_pos.x, src_pos.y, dest_pos.x, dest_pos.y, nr_traps, address)
+#end composite_trapezoids
+
+def composite_triangles(op, src, dest, mask_format, src_pos, dest_pos, triangles) :
+    "rasterizes the Triangles into a temporary mask with the specified format (e.g." \
+    " PIXMAN.a8), and composites Image src through it onto Image dest according to" \
+    " operator op (a PIXMAN.OP_xxx value). The triangle coordinates are relative to" \
+    " dest_pos in dest, and relative to src_pos in src."
+    if not isinstance(src, Image) or not isinstance(dest, Image) :
+        raise TypeError("image args must be Image objects")
+    #end if
+    if not isinstance(triangles, Triangles) :
+        raise TypeError("triangles must be a Triangles object")
+    #end if
+    src_pos = Point.from_tuple(src_pos).assert_isint()
+    dest_pos = Point.from_tuple(dest_pos).assert_isint()
+    address, nr_tris = triangles._to_pixman()
+    pixman.pixman_composite_triangles(op, src._pmobj, dest._pmobj, mask_format, src_pos.x, src_pos.y, dest_pos.x, dest_pos.y, nr_tris, address)
+#end composite_triangles
+
+class GlyphCache :
+    "wrapper for a Pixman glyph cache. Do not instantiate directly; use the create method.\n" \
+    "\n" \
+    "A GlyphCache holds copies of prerendered glyph Images, each identified by a" \
+    " (font_key, glyph_key) pair of integers; Pixman treats these as opaque" \
+    " pointer-sized values. The cache must be frozen while glyphs are being inserted," \
+    " and while any glyph handles returned from lookup or insert are in use. When" \
+    " the cache is thawed, Pixman evicts the least-recently-used glyphs if the cache" \
+    " has grown too large. A GlyphCache can be used as a context manager, which" \
+    " freezes it for the duration of the with-statement.\n" \
+    "\n" \
+    "Lists of glyphs to be composited can be passed either as ctypes arrays of" \
+    " PIXMAN.glyph_t, as returned from lookup_glyphs and to_pixman_array, or as" \
+    " sequences of (glyph, pos) pairs, where glyph is a handle returned from lookup" \
+    " or insert, and pos is an integer Point."
+
+    __slots__ = ("_pmobj",) # to forestall typos
+
+    def __init__(self, _pmobj) :
+        self._pmobj = _pmobj
+    #end __init__
+
+    def __del__(self) :
+        if self._pmobj != None :
+            pixman.pixman_glyph_cache_destroy(self._pmobj)
+            self._pmobj = None
+        #end if
+    #end __del__
+
+    @staticmethod
+    def create() :
+        "creates a new, empty GlyphCache."
+        result = pixman.pixman_glyph_cache_create()
+        if result == None :
+            raise MemoryError("unable to allocate glyph cache")
+        #end if
+        return \
+            GlyphCache(result)
+    #end create
+
+    def freeze(self) :
+        "freezes the cache, so glyphs can be inserted and glyph handles remain valid." \
+        " Freezes can be nested; each must be balanced by a call to thaw."
+        pixman.pixman_glyph_cache_freeze(self._pmobj)
+        return \
+            self
+    #end freeze
+
+    def thaw(self) :
+        "undoes a previous freeze. Once the last freeze is undone, Pixman may evict" \
+        " the least-recently-used glyphs, invalidating their handles."
+        pixman.pixman_glyph_cache_thaw(self._pmobj)
+        return \
+            self
+    #end thaw
+
+    def __enter__(self) :
+        return \
+            self.freeze()
+    #end __enter__
+
+    def __exit__(self, exception_type, exception_value, traceback) :
+        self.thaw()
+    #end __exit__
+
+    def lookup(self, font_key, glyph_key) :
+        "returns the handle for the glyph with the specified keys, or None if it is" \
+        " not in the cache."
+        return \
+            pixman.pixman_glyph_cache_lookup(self._pmobj, font_key, glyph_key)
+    #end lookup
+
+    def insert(self, font_key, glyph_key, origin, image) :
+        "inserts a copy of the specified bits Image into the cache under the specified" \
+        " keys, and returns the handle for the new glyph. origin is the integer Point" \
+        " within the Image that is to be placed at the glyph position. The cache must" \
+        " be frozen."
+        if not isinstance(image, Image) :
+            raise TypeError("image must be an Image")
+        #end if
+        origin = Point.from_tuple(origin).assert_isint()
+        result = pixman.pixman_glyph_cache_insert \
+            (self._pmobj, font_key, glyph_key, origin.x, origin.y, image._pmobj)
+        if result == None :
+            raise RuntimeError("Pixman couldn’t insert glyph (cache not frozen, or full?)")
+        #end if
+        return \
+            result
+    #end insert
+
+    def remove(self, font_key, glyph_key) :
+        "evicts the glyph with the specified keys from the cache, if present."
+        pixman.pixman_glyph_cache_remove(self._pmobj, font_key, glyph_key)
+        return \
+            self
+    #end remove
+
+    @staticmethod
+    def to_pixman_array(glyphs) :
+        "given a sequence of (glyph, pos) pairs, returns an array of Pixman glyph_t" \
+        " values along with the length of the array. A ctypes array of glyph_t is" \
+        " passed through unchanged."
+        if isinstance(glyphs, ct.Array) and glyphs._type_ is PIXMAN.glyph_t :
+            c_glyphs = glyphs
+            nr_glyphs = len(glyphs)
+        else :
+            nr_glyphs = len(glyphs)
+            c_glyphs = (PIXMAN.glyph_t * nr_glyphs)()
+            for i in range(nr_glyphs) :
+                glyph, pos = glyphs[i]
+                pos = Point.from_tuple(pos).assert_isint()
+                c_glyph = c_glyphs[i]
+                c_glyph.x = pos.x
+                c_glyph.y = pos.y
+                c_glyph.glyph = glyph
+            #end for
+        #end if
+        return \
+            c_glyphs, nr_glyphs
+    #end to_pixman_array
+
+    def lookup_glyphs(self, font_key, glyphs, render = None) :
+        "looks up a whole run of glyphs in one font, returning a ctypes array of" \
+        " PIXMAN.glyph_t suitable for passing to the composite methods. glyphs is a" \
+        " sequence of qahirah.Glyph objects, with the index used as the glyph_key and" \
+        " the pos rounded to integer coordinates. If a glyph is not in the cache, then" \
+        " render, if not None, is called as render(font_key, glyph_key) and must return" \
+        " an (image, origin) tuple to be inserted; otherwise KeyError is raised. The" \
+        " cache must be frozen, and remain so while the result is in use."
+        nr_glyphs = len(glyphs)
+        c_glyphs = (PIXMAN.glyph_t * nr_glyphs)()
+        for i in range(nr_glyphs) :
+            glyph = glyphs[i]
+            handle = pixman.pixman_glyph_cache_lookup(self._pmobj, font_key, glyph.index)
+            if handle == None :
+                if render == None :
+                    raise KeyError("glyph %d not in cache" % glyph.index)
+                #end if
+                image, origin = render(font_key, glyph.index)
+                handle = self.insert(font_key, glyph.index, origin, image)
+            #end if
+            c_glyph = c_glyphs[i]
+            c_glyph.x = round(glyph.pos.x)
+            c_glyph.y = round(glyph.pos.y)
+            c_glyph.glyph = handle
+        #end for
+        return \
+            c_glyphs
+    #end lookup_glyphs
+
+    def get_extents(self, glyphs) :
+        "returns the Rect enclosing all the specified glyphs."
+        c_glyphs, nr_glyphs = self.to_pixman_array(glyphs)
+        c_extents = PIXMAN.box32_t()
+        pixman.pixman_glyph_get_extents(self._pmobj, nr_glyphs, ct.byref(c_glyphs), ct.byref(c_extents))
+        return \
+            Rect.from_pixman_box(c_extents)
+    #end get_extents
+
+    def get_mask_format(self, glyphs) :
+        "returns the most suitable Pixman format code for a mask to hold the" \
+        " specified glyphs."
+        c_glyphs, nr_glyphs = self.to_pixman_array(glyphs)
+        return \
+            pixman.pixman_glyph_get_mask_format(self._pmobj, nr_glyphs, ct.byref(c_glyphs))
+    #end get_mask_format
+
+    def composite_glyphs(self, op, src, dest, glyphs, src_pos = (0, 0), dest_pos = (0, 0), mask_format = None) :
+        "composites an entire run of glyphs onto Image dest in a single call, using" \
+        " Image src as the source, according to operator op (a PIXMAN.OP_xxx value)." \
+        " The glyphs are first accumulated into a temporary mask with the specified" \
+        " format (determined from the glyphs if None). Each glyph position is taken" \
+        " relative to dest_pos in dest, and relative to src_pos in src."
+        if not isinstance(src, Image) or not isinstance(dest, Image) :
+            raise TypeError("image args must be Image objects")
+        #end if
+        src_pos = Point.from_tuple(src_pos).assert_isint()
+        dest_pos = Point.from_tuple(dest_pos).assert_isint()
+        c_glyphs, nr_glyphs = self.to_pixman_array(glyphs)
+        c_extents = PIXMAN.box32_t()
+        pixman.pixman_glyph_get_extents(self._pmobj, nr_glyphs, ct.byref(c_glyphs), ct.byref(c_extents))
+        if mask_format == None :
+            mask_format = pixman.pixman_glyph_get_mask_format(self._pmobj, nr_glyphs, ct.byref(c_glyphs))
+        #end if
+        pixman.pixman_composite_glyphs \
+          (
+            op,
+            src._pmobj,
+            dest._pmobj,
+            mask_format,
+            src_pos.x + c_extents.x1,
+            src_pos.y + c_extents.y1,
+            c_extents.x1,
+            c_extents.y1,
+            dest_pos.x + c_extents.x1,
+            dest_pos.y + c_extents.y1,
+            c_extents.x2 - c_extents.x1,
+            c_extents.y2 - c_extents.y1,
+            self._pmobj,
+            nr_glyphs,
+            ct.byref(c_glyphs)
+          )
+        return \
+            self
+    #end composite_glyphs
+
+    def composite_glyphs_no_mask(self, op, src, dest, glyphs, src_pos = (0, 0), dest_pos = (0, 0)) :
+        "composites an entire run of glyphs onto Image dest in a single call, using" \
+        " Image src as the source, according to operator op (a PIXMAN.OP_xxx value)." \
+        " Each glyph is composited directly onto dest, without an intermediate mask." \
+        " Each glyph position is taken relative to dest_pos in dest, and relative to" \
+        " src_pos in src."
+        if not isinstance(src, Image) or not isinstance(dest, Image) :
+            raise TypeError("image args must be Image objects")
+        #end if
+        src_pos = Point.from_tuple(src_pos).assert_isint()
+        dest_pos = Point.from_tuple(dest_pos).assert_isint()
+        c_glyphs, nr_glyphs = self.to_pixman_array(glyphs)
+        pixman.pixman_composite_glyphs_no_mask \
+          (
+            op,
+            src._pmobj,
+            dest._pmobj,
+            src_pos.x,
+            src_pos.y,
+            dest_pos.x,
+            dest_pos.y,
+            self._pmobj,
+            nr_glyphs,
+            ct.byref(c_glyphs)
+          )
+        return \
+            self
+    #end composite_glyphs_no_mask
+
+#end GlyphCache
+
+class TiledImage :
+    "a large logical bits image, stored as a grid of separate Image tiles which are" \
+    " only created when they are first touched. format is the Pixman format code for" \
+    " the tiles, dimensions is an integer Point giving the overall size, which may use" \
+    " the full 32-bit coordinate range, and tile_size is an integer Point giving the" \
+    " size of each tile (those along the right and bottom edges are cut short to fit" \
+    " the overall dimensions). Drawing operations only touch the tiles that intersect" \
+    " them.\n" \
+    "\n" \
+    "Memory use can be bounded by specifying max_tiles. Once more tiles than that are" \
+    " resident, the least-recently-used clean tiles are discarded. A tile becomes" \
+    " dirty when it is drawn into. If saver is not None, it is called as" \
+    " saver(index, tile_rect, image) to write back a dirty tile, which then becomes" \
+    " clean and can be discarded too; otherwise dirty tiles are never discarded, so" \
+    " max_tiles may be exceeded. If loader is not None, it is called as" \
+    " loader(index, tile_rect, image) to fill in each newly-created tile; otherwise" \
+    " new tiles start out cleared. In these calls, index is the (column, row) of the" \
+    " tile, tile_rect is the Rect it covers, and image is the tile Image."
+
+    __slots__ = \
+        (
+            "format",
+            "dimensions",
+            "tile_size",
+            "max_tiles",
+            "loader",
+            "saver",
+            "_tiles",
+            "_dirty",
+        ) # to forestall typos
+
+    def __init__(self, format, dimensions, tile_size = (256, 256), max_tiles = None, loader = None, saver = None) :
+        dimensions = Point.from_tuple(dimensions).assert_isint()
+        tile_size = Point.from_tuple(tile_size).assert_isint()
+        if dimensions.x < 0 or dimensions.y < 0 or tile_size.x <= 0 or tile_size.y <= 0 :
+            raise ValueError("invalid dimensions or tile_size")
+        #end if
+        if max_tiles != None and max_tiles < 1 :
+            raise ValueError("max_tiles must be at least 1")
+        #end if
+        self.format = format
+        self.dimensions = dimensions
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.loader = loader
+        self.saver = saver
+        self._tiles = OrderedDict() # in least-to-most-recently-used order
+        self._dirty = set()
+    #end __init__
+
+    @property
+    def grid(self) :
+        "the number of columns and rows of tiles."
+        return \
+            Point \
+              (
+                - (- self.dimensions.x // self.tile_size.x),
+                - (- self.dimensions.y // self.tile_size.y)
+              )
+    #end grid
+
+    def tile_rect(self, index) :
+        "returns the Rect covered by the tile with the specified (column, row) index."
+        col, row = index
+        left = col * self.tile_size.x
+        top = row * self.tile_size.y
+        return \
+            Rect \
+              (
+                left,
+                top,
+                min(self.tile_size.x, self.dimensions.x - left),
+                min(self.tile_size.y, self.dimensions.y - top)
+              )
+    #end tile_rect
+
+    def tiles_for_rect(self, rect) :
+        "iterates over the tiles intersecting the specified integer Rect, returning" \
+        " for each a tuple of its (column, row) index, the tile Rect, and the part of" \
+        " rect that falls within it, all in overall image coordinates."
+        rect = Rect.from_rect(rect).assert_isint()
+        x1 = max(rect.left, 0)
+        y1 = max(rect.top, 0)
+        x2 = min(rect.right, self.dimensions.x)
+        y2 = min(rect.bottom, self.dimensions.y)
+        if x1 < x2 and y1 < y2 :
+            tw, th = self.tile_size
+            for row in range(y1 // th, (y2 - 1) // th + 1) :
+                for col in range(x1 // tw, (x2 - 1) // tw + 1) :
+                    tile_rect = self.tile_rect((col, row))
+                    yield \
+                        (
+                            (col, row),
+                            tile_rect,
+                            Rect.from_corners
+                              (
+                                (max(x1, tile_rect.left), max(y1, tile_rect.top)),
+                                (min(x2, tile_rect.right), min(y2, tile_rect.bottom))
+                              ),
+                        )
+                #end for
+            #end for
+        #end if
+    #end tiles_for_rect
+
+    def get_tile(self, index, dirty = False) :
+        "returns the Image for the tile with the specified (column, row) index," \
+        " creating it if it is not resident. If dirty, the tile is marked as modified."
+        col, row = index
+        grid = self.grid
+        if not (0 <= col < grid.x and 0 <= row < grid.y) :
+            raise IndexError("tile index out of range")
+        #end if
+        index = (col, row)
+        tile = self._tiles.get(index)
+        if tile != None :
+            self._tiles.move_to_end(index)
+        else :
+            tile_rect = self.tile_rect(index)
+            tile = Image.create_bits(self.format, tile_rect.dimensions, clear = self.loader == None)
+            if self.loader != None :
+                self.loader(index, tile_rect, tile)
+            #end if
+            self._tiles[index] = tile
+            self._evict(keep = index)
+        #end if
+        if dirty :
+            self._dirty.add(index)
+        #end if
+        return \
+            tile
+    #end get_tile
+
+    def _evict(self, keep) :
+        # discards least-recently-used tiles, other than the one with index keep,
+        # until the number of resident tiles is within max_tiles (if possible).
+        if self.max_tiles != None :
+            excess = len(self._tiles) - self.max_tiles
+            if excess > 0 :
+                for index in list(self._tiles.keys()) :
+                    if excess == 0 :
+                        break
+                    if index != keep :
+                        if index in self._dirty and self.saver != None :
+                            self._save(index)
+                        #end if
+                        if index not in self._dirty :
+                            del self._tiles[index]
+                            excess -= 1
+                        #end if
+                    #end if
+                #end for
+            #end if
+        #end if
+    #end _evict
+
+    def _save(self, index) :
+        self.saver(index, self.tile_rect(index), self._tiles[index])
+        self._dirty.discard(index)
+    #end _save
+
+    def flush(self) :
+        "writes back all dirty tiles through the saver, leaving them clean."
+        if self.saver == None :
+            raise ValueError("no saver to flush tiles to")
+        #end if
+        for index in sorted(self._dirty) :
+            self._save(index)
+        #end for
+        return \
+            self
+    #end flush
+
+    @property
+    def n_resident(self) :
+        "the number of tiles currently resident in memory."
+        return \
+            len(self._tiles)
+    #end n_resident
+
+    def _tiles_region(self, indexes) :
+        return \
+            Region.create_rects(list(self.tile_rect(index) for index in indexes))[0]
+    #end _tiles_region
+
+    def resident_region(self) :
+        "returns a Region covering all the tiles currently resident in memory."
+        return \
+            self._tiles_region(self._tiles.keys())
+    #end resident_region
+
+    def dirty_region(self) :
+        "returns a Region covering all the tiles modified since they were last" \
+        " loaded or saved."
+        return \
+            self._tiles_region(self._dirty)
+    #end dirty_region
+
+    def tiles_in_region(self, region) :
+        "returns the set of (column, row) indexes of all tiles intersecting the" \
+        " specified Region."
+        if not isinstance(region, Region) :
+            raise TypeError("region must be a Region")
+        #end if
+        result = set()
+        for rect in region.rectangles() :
+            result.update(index for index, tile_rect, part in self.tiles_for_rect(rect))
+        #end for
+        return \
+            result
+    #end tiles_in_region
+
+    def composite(self, op, src, mask, src_pos, mask_pos, dest_pos, dimensions) :
+        "composites the specified portions of Image src through Image mask (if not" \
+        " None) onto this TiledImage, with arguments as for image_composite. Only the" \
+        " tiles intersecting the destination rectangle are touched. src and mask may" \
+        " have transforms and filters set: since each tile is composited with the" \
+        " correspondingly offset source and mask positions, the result is the same as" \
+        " compositing onto a single large Image."
+        if not isinstance(src, Image) or mask != None and not isinstance(mask, Image) :
+            raise TypeError("image args must be Image objects")
+        #end if
+        src_pos = Point.from_tuple(src_pos).assert_isint()
+        if mask != None or mask_pos != None :
+            mask_pos = Point.from_tuple(mask_pos).assert_isint()
+        else :
+            mask_pos = Point(0, 0) # dummy
+        #end if
+        dest_pos = Point.from_tuple(dest_pos).assert_isint()
+        dimensions = Point.from_tuple(dimensions).assert_isint()
+        if mask != None :
+            c_mask = mask._pmobj
+        else :
+            c_mask = None
+        #end if
+        for index, tile_rect, part in self.tiles_for_rect(Rect(dest_pos.x, dest_pos.y, dimensions.x, dimensions.y)) :
+            tile = self.get_tile(index, dirty = True)
+            dx = part.left - dest_pos.x
+            dy = part.top - dest_pos.y
+            pixman.pixman_image_composite32 \
+              (
+                op,
+                src._pmobj,
+                c_mask,
+                tile._pmobj,
+                src_pos.x + dx,
+                src_pos.y + dy,
+                mask_pos.x + dx,
+                mask_pos.y + dy,
+                part.left - tile_rect.left,
+                part.top - tile_rect.top,
+                part.width,
+                part.height
+              )
+        #end for
+        return \
+            self
+    #end composite
+
+    def composite_to(self, op, mask, dest, src_pos, mask_pos, dest_pos, dimensions) :
+        "composites the specified portion of this TiledImage through Image mask (if" \
+        " not None) onto Image dest, with the remaining arguments as for image_composite." \
+        " Only the tiles intersecting the source rectangle are touched. Note that the" \
+        " tiles are read without any transform or filter."
+        if not isinstance(dest, Image) or mask != None and not isinstance(mask, Image) :
+            raise TypeError("image args must be Image objects")
+        #end if
+        src_pos = Point.from_tuple(src_pos).assert_isint()
+        if mask != None or mask_pos != None :
+            mask_pos = Point.from_tuple(mask_pos).assert_isint()
+        else :
+            mask_pos = Point(0, 0) # dummy
+        #end if
+        dest_pos = Point.from_tuple(dest_pos).assert_isint()
+        dimensions = Point.from_tuple(dimensions).assert_isint()
+        if mask != None :
+            c_mask = mask._pmobj
+        else :
+            c_mask = None
+        #end if
+        for index, tile_rect, part in self.tiles_for_rect(Rect(src_pos.x, src_pos.y, dimensions.x, dimensions.y)) :
+            tile = self.get_tile(index)
+            dx = part.left - src_pos.x
+            dy = part.top - src_pos.y
+            pixman.pixman_image_composite32 \
+              (
+                op,
+                tile._pmobj,
+                c_mask,
+                dest._pmobj,
+                part.left - tile_rect.left,
+                part.top - tile_rect.top,
+                mask_pos.x + dx,
+                mask_pos.y + dy,
+                dest_pos.x + dx,
+                dest_pos.y + dy,
+                part.width,
+                part.height
+              )
+        #end for
+        return \
+            self
+    #end composite_to
+
+    def fill_rectangles(self, op, colour, rects) :
+        "fills the specified sequence of rectangles using the given colour and operator," \
+        " touching only the tiles they intersect."
+        tile_rects = {}
+        for rect in rects :
+            for index, tile_rect, part in self.tiles_for_rect(rect) :
+                if index not in tile_rects :
+                    tile_rects[index] = []
+                #end if
+                tile_rects[index].append(part - tile_rect.topleft)
+            #end for
+        #end for
+        for index in tile_rects :
+            self.get_tile(index, dirty = True).fill_rectangles(op, colour, tile_rects[index])
+        #end for
+        return \
+            self
+    #end fill_rectangles
+
+#end TiledImage
+
+class DamageTracker :
+    "accumulates the areas of a destination that need repainting, so that a repaint" \
+    " only composites the damaged boxes instead of the whole destination. If bounds" \
+    " is not None, it is a Rect to which all damage is clipped. If coalesce_threshold" \
+    " is not None, then whenever the damage consists of more boxes than that, nearby" \
+    " boxes are merged into their bounding boxes until it does not, trading some" \
+    " extra repainted area for fewer composite calls."
+
+    __slots__ = ("bounds", "coalesce_threshold", "_damage") # to forestall typos
+
+    def __init__(self, bounds = None, coalesce_threshold = None) :
+        if bounds != None :
+            bounds = Rect.from_rect(bounds).assert_isint()
+        #end if
+        if coalesce_threshold != None and coalesce_threshold < 1 :
+            raise ValueError("coalesce_threshold must be at least 1")
+        #end if
+        self.bounds = bounds
+        self.coalesce_threshold = coalesce_threshold
+        self._damage = Region.create()
+    #end __init__
+
+    def _clip(self) :
+        if self.bounds != None :
+            self._damage.intersect_rect(self.bounds, self._damage)
+        #end if
+    #end _clip
+
+    def add(self, rect) :
+        "adds a Rect to the damage."
+        rect = Rect.from_rect(rect).assert_isint()
+        if self.bounds != None :
+            rect = Rect.from_rect(rect.intersection(self.bounds))
+        #end if
+        if rect.width > 0 and rect.height > 0 :
+            self._damage.union_rect(rect, self._damage)
+        #end if
+        return \
+            self
+    #end add
+
+    def add_rects(self, rects) :
+        "adds a sequence of Rects to the damage."
+        self._damage |= Region.create_rects(rects)[0]
+        self._clip()
+        return \
+            self
+    #end add_rects
+
+    def add_region(self, region) :
+        "adds a Region to the damage."
+        self._damage |= region
+        self._clip()
+        return \
+            self
+    #end add_region
+
+    @property
+    def damage(self) :
+        "a copy of the currently-accumulated damage, coalesced if appropriate."
+        self.coalesce()
+        result = Region.create()
+        self._damage.copy(result)
+        return \
+            result
+    #end damage
+
+    @property
+    def not_empty(self) :
+        "whether there is any damage to repaint."
+        return \
+            self._damage.not_empty
+    #end not_empty
+
+    def reset(self) :
+        "discards all accumulated damage."
+        self._damage.clear()
+        return \
+            self
+    #end reset
+
+    def coalesce(self, threshold = None) :
+        "reduces the damage to at most threshold boxes (defaulting to" \
+        " coalesce_threshold; does nothing if both are None). Each round merges the" \
+        " pairs of boxes, adjacent in y-x order, whose bounding boxes waste the least" \
+        " area, just enough of them to reach the threshold. If the Region banding" \
+        " stops this from making progress, the damage becomes its extents."
+        if threshold == None :
+            threshold = self.coalesce_threshold
+        #end if
+        if threshold != None :
+            while True :
+                boxes = self._damage.boxes().tolist()
+                nr_boxes = len(boxes)
+                if nr_boxes <= threshold :
+                    break
+                #end if
+                if threshold == 1 :
+                    self._damage.reset(self._damage.extents)
+                    break
+                #end if
+                boxes.sort(key = lambda b : (b[1], b[0]))
+                candidates = []
+                for i in range(nr_boxes - 1) :
+                    b1, b2 = boxes[i], boxes[i + 1]
+                    merged = (min(b1[0], b2[0]), min(b1[1], b2[1]), max(b1[2], b2[2]), max(b1[3], b2[3]))
+                    waste = \
+                        (
+                            (merged[2] - merged[0]) * (merged[3] - merged[1])
+                        -
+                            (b1[2] - b1[0]) * (b1[3] - b1[1])
+                        -
+                            (b2[2] - b2[0]) * (b2[3] - b2[1])
+                        )
+                    candidates.append((waste, i, merged))
+                #end for
+                candidates.sort()
+                need = nr_boxes - threshold
+                used = set()
+                for waste, i, merged in candidates :
+                    if need == 0 :
+                        break
+                    #end if
+                    if i not in used and i + 1 not in used :
+                        used.update((i, i + 1))
+                        boxes[i] = merged
+                        boxes[i + 1] = None
+                        need -= 1
+                    #end if
+                #end for
+                coalesced = Region.create_from_boxes \
+                  (
+                    array.array("i", itertools.chain.from_iterable(b for b in boxes if b != None))
+                  )[0]
+                if coalesced.n_rects >= nr_boxes :
+                    # merged boxes overlapped others and got split up again
+                    coalesced.reset(coalesced.extents)
+                #end if
+                self._damage = coalesced
+            #end while
+        #end if
+        return \
+            self
+    #end coalesce
+
+    def repaint(self, op, src, mask, dest, src_pos = (0, 0), mask_pos = (0, 0)) :
+        "composites src (and mask, if not None) onto dest over just the damaged boxes," \
+        " with one batched image_composite_many call, then resets the damage. src_pos" \
+        " and mask_pos are the positions in src and mask that correspond to the origin" \
+        " of dest. Returns the Region that was repainted, e.g. for presenting just" \
+        " those areas."
+        src_pos = Point.from_tuple(src_pos).assert_isint()
+        if mask != None :
+            mask_pos = Point.from_tuple(mask_pos).assert_isint()
+            images = (src, mask, dest)
+            mask_index = 1
+        else :
+            mask_pos = Point(0, 0)
+            images = (src, dest)
+            mask_index = -1
+        #end if
+        dest_index = len(images) - 1
+        self.coalesce()
+        ops = array.array("i")
+        for x1, y1, x2, y2 in self._damage.boxes().tolist() :
+            ops.extend \
+              (
+                (
+                    op, 0, mask_index, dest_index,
+                    src_pos.x + x1, src_pos.y + y1,
+                    mask_pos.x + x1, mask_pos.y + y1,
+                    x1, y1,
+                    x2 - x1, y2 - y1,
+                )
+              )
+        #end for
+        image_composite_many(ops, images)
+        result = self._damage
+        self._damage = Region.create()
+        return \
+            result
+    #end repaint
+
+#end DamageTracker
+
+class ImagePool(_CacheStats) :
+    "recycles bits Images, so that creating and discarding many intermediate Images" \
+    " of the same format and dimensions does not keep allocating new pixel buffers." \
+    " Images obtained with acquire are returned with release, and kept for reuse by" \
+    " later acquire calls for the same format and dimensions, up to a total of" \
+    " max_bytes of pixels; beyond that the least-recently-released are discarded." \
+    " If clear, then reused Images have their pixels zeroed, like newly-created ones." \
+    " Released Images have their transform, filter, repeat, clipping, component-alpha," \
+    " alpha-map and palette settings reset to the defaults. All methods are thread-safe."
+
+    __slots__ = \
+        (
+            "max_bytes",
+            "clear",
+            "_free", # image id => (key, image, nr_bytes), in least-to-most-recently-released order
+            "_by_key", # key => OrderedDict of image ids in _free, in same order
+            "_size",
+            "_lock",
+        ) # to forestall typos
+
+    count_name = "images"
+    limit_name = "max_bytes"
+
+    def __init__(self, max_bytes, clear = True) :
+        self.max_bytes = max_bytes
+        self.clear = clear
+        self._reset_stats()
+        self._free = OrderedDict()
+        self._by_key = {}
+        self._size = 0
+        self._lock = threading.Lock()
+    #end __init__
+
+    def _remove(self, image_id) :
+        # removes an entry from the free lists. Caller must hold the lock.
+        key, image, nr_bytes = self._free.pop(image_id)
+        ids = self._by_key[key]
+        del ids[image_id]
+        if len(ids) == 0 :
+            del self._by_key[key]
+        #end if
+        self._size -= nr_bytes
+        return \
+            image
+    #end _remove
+
+    def acquire(self, format, dimensions) :
+        "returns a bits Image with the specified format and dimensions, reusing a" \
+        " released one if available."
+        dimensions = Point.from_tuple(dimensions).assert_isint()
+        key = (format, dimensions.x, dimensions.y)
+        with self._lock :
+            ids = self._by_key.get(key)
+            if ids != None :
+                # take most recently released, as most likely to still be in cache
+                image_id = next(reversed(ids))
+                result = self._remove(image_id)
+                self.hits += 1
+            else :
+                result = None
+                self.misses += 1
+            #end if
+        #end with
+        if result != None :
+            if self.clear :
+                ct.memset(result.data, 0, result.stride * result.height)
+            #end if
+        else :
+            result = Image.create_bits(format, dimensions, clear = self.clear)
+        #end if
+        return \
+            result
+    #end acquire
+
+    def release(self, image) :
+        "returns an Image obtained from acquire to the pool. The caller must not use" \
+        " it afterwards."
+        if not isinstance(image, Image) :
+            raise TypeError("image must be an Image")
+        #end if
+        if image.data == None :
+            raise ValueError("not a bits Image")
+        #end if
+        image._reset_state()
+        key = (image.format, image.width, image.height)
+        nr_bytes = abs(image.stride) * image.height
+        with self._lock :
+            image_id = id(image)
+            if image_id not in self._free :
+                self._free[image_id] = (key, image, nr_bytes)
+                self._by_key.setdefault(key, OrderedDict())[image_id] = None
+                self._size += nr_bytes
+            #end if
+            while self._size > self.max_bytes :
+                self._remove(next(iter(self._free)))
+                self.evictions += 1
+            #end while
+        #end with
+    #end release
+
+    @contextlib.contextmanager
+    def image(self, format, dimensions) :
+        "context manager which acquires an Image on entry and releases it on exit."
+        image = self.acquire(format, dimensions)
+        try :
+            yield image
+        finally :
+            self.release(image)
+        #end try
+    #end image
+
+    def flush(self) :
+        "discards all Images currently held for reuse."
+        with self._lock :
+            self._free.clear()
+            self._by_key.clear()
+            self._size = 0
+        #end with
+        return \
+            self
+    #end flush
+
+    def __len__(self) :
+        "the number of Images currently held for reuse."
+        return \
+            len(self._free)
+    #end __len__
+
+    @property
+    def size(self) :
+        "the total bytes of pixels currently held for reuse."
+        return \
+            self._size
+    #end size
+
+#end ImagePool
+
+class GradientCache :
+    "memoizing factory for gradient Images, so that drawing the same gradients over" \
+    " and over does not keep recreating them. Requests with the same geometry" \
+    " (compared after conversion to Pixman’s fixed-point values) and the same stop" \
+    " positions and colour components return the same Image, so callers must not" \
+    " change its settings.\n" \
+    "\n" \
+    "Each factory method also takes an optional bake argument: if not None, it is an" \
+    " integer Point giving the dimensions of a bits Image into which the gradient is" \
+    " rendered once, covering the gradient coordinates from (0, 0). The baked Image," \
+    " which has the specified format and repeat settings, is then cached and returned" \
+    " instead, so compositing from it is a plain pixel copy rather than evaluating the" \
+    " gradient for every pixel.\n" \
+    "\n" \
+    "max_gradients limits the number of gradient Images kept, and max_baked_bytes the" \
+    " total pixel bytes of baked Images; in each case the least-recently-used are" \
+    " discarded beyond that."
+
+    __slots__ = ("gradients", "baked") # to forestall typos
+
+    def __init__(self, max_gradients = 64, max_baked_bytes = 16 << 20) :
+        self.gradients = LRUCache(max_size = max_gradients)
+        self.baked = LRUCache \
+          (
+            max_size = max_baked_bytes,
+            size_of = lambda image : abs(image.stride) * image.height
+          )
+    #end __init__
+
+    @staticmethod
+    def _stops_key(stops) :
+        # the stops are only converted to Pixman form if the gradient has to be created.
+        return \
+            tuple((stop.x,) + tuple(stop.colour) for stop in stops)
+    #end _stops_key
+
+    def _get(self, key, create, bake, format, repeat) :
+        if bake != None :
+            bake = Point.from_tuple(bake).assert_isint()
+
+            def create_baked() :
+                gradient = self.gradients.get(key, create)
+                result = Image.create_bits(format, bake, clear = False)
+                image_composite(PIXMAN.OP_SRC, gradient, None, result, (0, 0), None, (0, 0), bake)
+                result.set_repeat(repeat)
+                return \
+                    result
+            #end create_baked
+
+            result = self.baked.get(key + (tuple(bake), format, repeat), create_baked)
+        else :
+            result = self.gradients.get(key, create)
+        #end if
+        return \
+            result
+    #end _get
+
+    def linear(self, p1, p2, stops, bake = None, format = PIXMAN.a8r8g8b8, repeat = PIXMAN.REPEAT_PAD) :
+        "returns a cached Image as for Image.create_linear_gradient, or a baked version."
+        c_p1 = Point.from_tuple(p1).to_pixman_fixed()
+        c_p2 = Point.from_tuple(p2).to_pixman_fixed()
+        return \
+            self._get \
+              (
+                ("linear", c_p1.x, c_p1.y, c_p2.x, c_p2.y, self._stops_key(stops)),
+                lambda : Image.create_linear_gradient(p1, p2, stops),
+                bake, format, repeat
+              )
+    #end linear
+
+    def radial(self, inner, outer, inner_radius, outer_radius, stops, bake = None, format = PIXMAN.a8r8g8b8, repeat = PIXMAN.REPEAT_PAD) :
+        "returns a cached Image as for Image.create_radial_gradient, or a baked version."
+        c_inner = Point.from_tuple(inner).to_pixman_fixed()
+        c_outer = Point.from_tuple(outer).to_pixman_fixed()
+        return \
+            self._get \
+              (
+                (
+                    "radial",
+                    c_inner.x, c_inner.y, c_outer.x, c_outer.y,
+                    PIXMAN.double_to_fixed(inner_radius),
+                    PIXMAN.double_to_fixed(outer_radius),
+                    self._stops_key(stops),
+                ),
+                lambda : Image.create_radial_gradient(inner, outer, inner_radius, outer_radius, stops),
+                bake, format, repeat
+              )
+    #end radial
+
+    def conical(self, centre, angle, stops, bake = None, format = PIXMAN.a8r8g8b8, repeat = PIXMAN.REPEAT_PAD) :
+        "returns a cached Image as for Image.create_conical_gradient, or a baked version."
+        c_centre = Point.from_tuple(centre).to_pixman_fixed()
+        return \
+            self._get \
+              (
+                (
+                    "conical",
+                    c_centre.x, c_centre.y,
+                    PIXMAN.double_to_fixed(angle / qah.deg),
+                    self._stops_key(stops),
+                ),
+                lambda : Image.create_conical_gradient(centre, angle, stops),
+                bake, format, repeat
+              )
+    #end conical
+
+    def clear(self) :
+        "discards all cached Images."
+        self.gradients.clear()
+        self.baked.clear()
+        return \
+            self
+    #end clear
+
+#end GradientCache
+
+class SolidFillCache :
+    "thread-safe cache of solid-fill Images, so that compositing with constant colours" \
+    " does not allocate a new Pixman image every time. Colours are keyed by their" \
+    " premultiplied 16-bit PIXMAN.color_t values, and up to max_entries of them are" \
+    " kept, discarding the least-recently-used beyond that. The opacity masks, one for" \
+    " each 8-bit alpha level, are kept separately and never discarded. The returned" \
+    " Images are shared, so callers must not change their settings. A default" \
+    " instance is available as SolidFillCache.default."
+
+    __slots__ = ("fills", "_masks", "_masks_lock") # to forestall typos
+
+    def __init__(self, max_entries = 256) :
+        self.fills = LRUCache(max_size = max_entries)
+        self._masks = [None] * 256
+        self._masks_lock = threading.Lock()
+    #end __init__
+
+    def get(self, colour) :
+        "returns a solid-fill Image for the given Colour."
+        c_colour = Colour.from_colour(colour).to_pixman()
+        return \
+            self.fills.get \
+              (
+                (c_colour.red, c_colour.green, c_colour.blue, c_colour.alpha),
+                lambda : Image(pixman.pixman_image_create_solid_fill(ct.byref(c_colour)))
+              )
+    #end get
+
+    def opacity_mask(self, alpha) :
+        "returns a solid-fill Image for use as a mask to composite at the given opacity," \
+        " a real in [0, 1], quantized to 8 bits. All its components are equal to the" \
+        " alpha, so it works as a component-alpha mask as well."
+        if not 0 <= alpha <= 1 :
+            raise ValueError("alpha must be in [0, 1]")
+        #end if
+        level = round(alpha * 255)
+        result = self._masks[level]
+        if result == None :
+            with self._masks_lock :
+                result = self._masks[level]
+                if result == None :
+                    value = level * 257 # 8-bit to 16-bit
+                    c_colour = PIXMAN.color_t(red = value, green = value, blue = value, alpha = value)
+                    result = Image(pixman.pixman_image_create_solid_fill(ct.byref(c_colour)))
+                    self._masks[level] = result
+                #end if
+            #end with
+        #end if
+        return \
+            result
+    #end opacity_mask
+
+    def clear(self) :
+        "discards all cached Images."
+        self.fills.clear()
+        with self._masks_lock :
+            self._masks = [None] * 256
+        #end with
+        return \
+            self
+    #end clear
+
+#end SolidFillCache
+SolidFillCache.default = SolidFillCache()
+
+class FillBatch :
+    "collects many box fills, in any number of colours and operators, and performs them" \
+    " with one pixman_image_fill_boxes call per distinct (operator, colour) group, without" \
+    " creating any Python objects per box. Groups are filled in the order in which they" \
+    " were first added to, so where boxes in different groups overlap, the later group" \
+    " wins regardless of the order in which the individual boxes were added."
+
+    __slots__ = ("_groups",) # to forestall typos
+
+    def __init__(self) :
+        self._groups = OrderedDict() # (op, colour key) => (PIXMAN.color_t, array.array of box coords)
+    #end __init__
+
+    def _group_boxes(self, op, colour) :
+        # returns the box array for the specified group, creating it if necessary.
+        c_colour = Colour.from_colour(colour).to_pixman()
+        key = (op, c_colour.red, c_colour.green, c_colour.blue, c_colour.alpha)
+        group = self._groups.get(key)
+        if group == None :
+            group = (c_colour, array.array("i"))
+            self._groups[key] = group
+        #end if
+        return \
+            group[1]
+    #end _group_boxes
+
+    def add(self, op, colour, boxes) :
+        "adds boxes to be filled with the specified operator and Colour. boxes is a flat" \
+        " sequence of 32-bit integers taken in groups of four as x1, y1, x2, y2 box" \
+        " coordinates, e.g. an array.array(\"i\"), or a NumPy array of integers, which" \
+        " is converted in bulk with a check that the values fit in 32 bits."
+        c_boxes = _int32_view(boxes)
+        if len(c_boxes) % 4 != 0 :
+            raise ValueError("number of box coordinates must be a multiple of 4")
+        #end if
+        self._group_boxes(op, colour).frombytes(c_boxes.cast("B"))
+        return \
+            self
+    #end add
+
+    def add_rect(self, op, colour, rect) :
+        "adds a single integer Rect to be filled with the specified operator and Colour."
+        rect = Rect.from_rect(rect).assert_isint()
+        self._group_boxes(op, colour).extend((rect.left, rect.top, rect.right, rect.bottom))
+        return \
+            self
+    #end add_rect
+
+    def __len__(self) :
+        "the total number of boxes in the batch."
+        return \
+            sum(len(group[1]) for group in self._groups.values()) // 4
+    #end __len__
+
+    def fill(self, image) :
+        "performs all the fills in the batch on the specified Image. The batch is left" \
+        " unchanged, so it can be applied again."
+        if not isinstance(image, Image) :
+            raise TypeError("image must be an Image")
+        #end if
+        for key, (c_colour, boxes) in self._groups.items() :
+            op = key[0]
+            nr_boxes = len(boxes) // 4
+            if nr_boxes != 0 :
+                c_boxes = (PIXMAN.box32_t * nr_boxes).from_buffer(boxes)
+                if not pixman.pixman_image_fill_boxes(op, image._pmobj, ct.byref(c_colour), nr_boxes, ct.byref(c_boxes)) :
+                    raise MemoryError("pixman_image_fill_boxes failure")
+                #end if
+                del c_boxes # release buffer export so boxes can be extended again
+            #end if
+        #end for
+        return \
+            self
+    #end fill
+
+    def clear(self) :
+        "removes all boxes from the batch."
+        self._groups.clear()
+        return \
+            self
+    #end clear
+
+#end FillBatch
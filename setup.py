@@ -14,7 +14,7 @@ distutils.core.setup \
   (
     name = "Pixman",
     version = "0.3",
-    description = "language bindings for the Pixman graphics library, for Python 3.2 or later",
+    description = "language bindings for the Pixman graphics library, for Python 3.8 or later",
     author = "Lawrence D'Oliveiro",
     author_email = "ldo@geek-central.gen.nz",
     url = "http://github.com/ldo/python_pixman",
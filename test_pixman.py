@@ -0,0 +1,61 @@
+import array
+import ctypes as ct
+import pytest
+
+try :
+    import pixman
+except (ImportError, OSError) as fail :
+    pytest.skip("pixman module unavailable: %s" % fail, allow_module_level = True)
+#end try
+
+@pytest.mark.parametrize \
+  (
+    "make_buffer",
+    [
+        lambda values : (ct.c_int32 * len(values))(*values),
+        lambda values : array.array("l", values),
+        lambda values : bytearray(array.array("i", values).tobytes()),
+    ]
+  )
+def test_shapelist_from_other_buffer(make_buffer) :
+    values = list(range(20))
+    traps = pixman.Trapezoids.from_fixed(make_buffer(values))
+    assert len(traps) == 2
+    assert traps.fixed.typecode == pixman.PIXMAN.fixed_t._type_
+    assert traps.fixed.tolist() == values
+#end test_shapelist_from_other_buffer
+
+def test_shapelist_from_ndarray() :
+    numpy = pytest.importorskip("numpy")
+    values = numpy.arange(12, dtype = numpy.int64).reshape((2, 6))
+    traps = pixman.Traps.from_fixed(values)
+    assert len(traps) == 2
+    assert traps.fixed.tolist() == list(range(12))
+#end test_shapelist_from_ndarray
+
+def test_shapelist_from_fixed_array_not_copied() :
+    fixed = array.array(pixman.PIXMAN.fixed_t._type_, range(6))
+    assert pixman.Triangles.from_fixed(fixed).fixed is fixed
+#end test_shapelist_from_fixed_array_not_copied
+
+def test_shapelist_rejects_non_integer_buffer() :
+    with pytest.raises(TypeError) :
+        pixman.Traps.from_fixed(array.array("d", range(6)))
+    #end with
+#end test_shapelist_rejects_non_integer_buffer
+
+def test_shapelist_rejects_float_ndarray() :
+    numpy = pytest.importorskip("numpy")
+    with pytest.raises(TypeError) :
+        pixman.Traps.from_fixed(numpy.arange(6, dtype = numpy.float64) + 0.5)
+    #end with
+#end test_shapelist_rejects_float_ndarray
+
+def test_shapelist_rejects_out_of_range_ndarray() :
+    numpy = pytest.importorskip("numpy")
+    values = numpy.zeros(6, dtype = numpy.int64)
+    values[3] = 1 << 40
+    with pytest.raises(ValueError) :
+        pixman.Traps.from_fixed(values)
+    #end with
+#end test_shapelist_rejects_out_of_range_ndarray